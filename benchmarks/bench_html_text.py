@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" bench_html_text.py
+
+    Сравнение скорости HTMLText.to_text() (с обрезкой текста, как
+    в rssmailer.feed_items_to_html()) с прежней реализацией на описаниях
+    размером около 100 КБ, с проверкой того, что результаты совпадают.
+
+    Запуск: python3 benchmarks/bench_html_text.py"""
+
+
+import sys
+import os.path
+from timeit import timeit
+from html.parser import HTMLParser
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from rssmailerconfig import MAX_SHORT_DESCRIPTION_CHARS, MAX_LONG_DESCRIPTION_CHARS
+from rssmailerfeeds import HTMLText
+
+
+class HTMLTextOld(HTMLParser):
+    """Прежняя реализация HTMLText - для сравнения."""
+
+    EOLTAGS = set((u'br', u'p'))
+
+    def __init__(self, lbchr=u'\n'):
+        HTMLParser.__init__(self)
+        self.text = u''
+        self.linebreakchar = lbchr
+
+    def handle_starttag(self, tag, attrs):
+        self.handle_startendtag(tag, attrs)
+
+    def handle_startendtag(self, tag, attrs):
+        tag = tag.lower()
+        if tag in self.EOLTAGS:
+            self.text += u'\n'
+
+    def handle_data(self, data):
+        self.text += data
+
+    def to_text(self, html):
+        self.reset()
+        self.feed(html)
+
+        t = filter(None, self.text.split(u'\n'))
+
+        return self.linebreakchar.join(map(lambda s: u' '.join(s.split()), t))
+
+
+def to_text_old(html, maxlen):
+    """Как было в rssmailer.feed_to_html()."""
+
+    fdesc = HTMLTextOld(u'<br>').to_text(html)
+    if len(fdesc) > maxlen:
+        fdesc = fdesc[:maxlen] + u'...'
+
+    return fdesc
+
+
+def make_description(size, seed):
+    """Описание записи размером около size символов: HTML с абзацами,
+    переводами строк, ссылками, сущностями, кириллицей и т.п."""
+
+    rnd = random.Random(seed)
+
+    words = (u'Lorem', u'ipsum', u'dolor', u'Съешь', u'ещё', u'этих', u'мягких',
+        u'французских', u'булок', u'2026', u'<p>', u'</p>', u'<br>', u'<br/>',
+        u'<a href="http://example.com/">', u'</a>', u'<b>', u'</b>', u'&nbsp;',
+        u'&amp;', u'&#1046;', u'\n', u'\n\n', u'\t', u'  ', u'—', u'<!-- c -->',
+        u'<img src="x.png">', u'<P>', u'<BR>')
+
+    parts = []
+    n = 0
+    while n < size:
+        w = rnd.choice(words)
+        parts.append(w)
+        n += len(w) + 1
+
+    return rnd.choice((u' ', u'')).join(parts)
+
+
+def main():
+    size = 100 * 1024
+    repeat = 10
+
+    # разные строки - чтобы не мерять что-нибудь закэшированное
+    descs = [make_description(size, seed) for seed in range(repeat)]
+
+    # короткие описания всякого рода - для проверки совпадения результатов
+    checks = [make_description(random.Random(seed).randint(0, 2000), seed) for seed in range(3000)]
+
+    stripper = HTMLText(u'<br>')
+
+    print('%8s %10s %12s %12s %8s' % ('maxlen', 'size', 'old, ms', 'new, ms', 'speedup'))
+
+    for maxlen in (MAX_SHORT_DESCRIPTION_CHARS, MAX_LONG_DESCRIPTION_CHARS):
+        for d in descs + checks:
+            for ml in (maxlen, 1, 7, 100):
+                if to_text_old(d, ml) != stripper.to_text(d, ml):
+                    print('text mismatch (maxlen %d)!' % ml)
+                    return 1
+
+        told = timeit(lambda: [to_text_old(d, maxlen) for d in descs], number=1) / repeat
+        tnew = timeit(lambda: [stripper.to_text(d, maxlen) for d in descs], number=1) / repeat
+
+        print('%8d %10d %12.3f %12.3f %7.1fx' % (maxlen, size, told * 1000, tnew * 1000, told / tnew))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
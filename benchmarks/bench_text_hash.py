@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" bench_text_hash.py
+
+    Сравнение скорости text_hash() с прежней реализацией на длинных
+    описаниях (как в лентах с longdesc = yes), с проверкой того,
+    что результаты совпадают.
+
+    Запуск: python3 benchmarks/bench_text_hash.py"""
+
+
+import sys
+import os.path
+from timeit import timeit
+from hashlib import md5
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from rssmailerfeeds import text_hash, _text_hash, TEXT_HASH_CACHE_MAX_LEN
+
+
+def text_hash_old(txt):
+    """Прежняя реализация text_hash() - для сравнения."""
+
+    txt = txt.strip()
+    return u'' if not txt else md5((u''.join(filter(lambda c: c.isalnum(), txt))).lower().encode('utf-8', errors='replace')).hexdigest()
+
+
+def make_description(size, seed, asciionly):
+    """Описание записи размером около size символов: HTML, латиница,
+    кириллица (если asciionly == False), цифры, пунктуация."""
+
+    rnd = random.Random(seed)
+
+    words = (u'Lorem', u'ipsum', u'dolor', u'Съешь', u'ещё', u'этих', u'мягких',
+        u'французских', u'булок', u'2026', u'<p>', u'</p>', u'<a href="http://example.com/">',
+        u'</a>', u'&nbsp;', u'—', u'...', u'(C)', u'_x_', u'Ⅻ', u'½')
+
+    if asciionly:
+        words = tuple(filter(lambda w: w.isascii(), words))
+
+    parts = []
+    n = 0
+    while n < size:
+        w = rnd.choice(words)
+        parts.append(w)
+        n += len(w) + 1
+
+    return u' '.join(parts)
+
+
+def main():
+    sizes = (512, 16384, 131072)
+    repeat = 20
+
+    print('%6s %10s %12s %12s %8s' % ('text', 'size', 'old, ms', 'new, ms', 'speedup'))
+
+    for asciionly in (False, True):
+        for size in sizes:
+            # разные строки - чтобы не мерять кэш
+            descs = [make_description(size, seed, asciionly) for seed in range(repeat)]
+
+            for d in descs:
+                if text_hash_old(d) != text_hash(d):
+                    print('hash mismatch at size %d!' % size)
+                    return 1
+
+            tnew = timeit(lambda: [_text_hash(d) for d in descs], number=1) / repeat
+            told = timeit(lambda: [text_hash_old(d) for d in descs], number=1) / repeat
+
+            print('%6s %10d %12.3f %12.3f %7.1fx' % ('ascii' if asciionly else 'mixed',
+                size, told * 1000, tnew * 1000, told / tnew))
+
+    # повторный расчёт для того же (короткого) текста берётся из кэша
+    d = make_description(TEXT_HASH_CACHE_MAX_LEN - 64, 0, False)
+    text_hash(d)
+    tcached = timeit(lambda: text_hash(d), number=1000) / 1000
+    print('cached (%d): %.3f ms' % (len(d), tcached * 1000))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
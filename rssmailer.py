@@ -19,15 +19,19 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>."""
 
 
-RELEASE = '20200512-0'
+RELEASE = '20261018-0'
 APP_TITLE = 'RSSMailer'
 APP_RELEASE = u'%s v%s' % (APP_TITLE, RELEASE)
 
 import os.path, sys
+import threading
+import queue
 
 from rssmailerconfig import *
 from rssmailerfeeds import *
 from rssmailersender import *
+from rssmailerhistory import *
+from rssmailerspool import *
 from rssmailerlogger import log_exception_info
 from logging import shutdown as logging_shutdown
 
@@ -54,19 +58,20 @@ span.mark { border:1pt solid #fff; width:1ch }
 """ + body + u'\n</body></html>'
 
 
-def feed_to_html(feed):
+def feed_items_to_html(feed):
     """Форматирование содержимого feed.items в HTML.
 
-    feed    - экземпляр rssmailfeeds.RSSFeed."""
+    feed    - экземпляр rssmailfeeds.RSSFeed.
+    Возвращает список строк."""
 
     maxlen = MAX_LONG_DESCRIPTION_CHARS if feed.longdesc else MAX_SHORT_DESCRIPTION_CHARS
 
-    msgbody = [u'<h2>%s</h2>\n' % feed.title]
+    msgbody = []
+
+    stripper = HTMLText(u'<br>')
 
     for item in feed.items:
-        fdesc = HTMLText(u'<br>').to_text(item.description)
-        if len(fdesc) > maxlen:
-            fdesc = fdesc[:maxlen] + u'...'
+        fdesc = stripper.to_text(item.description, maxlen)
         if not fdesc:
             fdesc = u'&nbsp;'
 
@@ -87,78 +92,506 @@ def feed_to_html(feed):
 <div class="desc">%s</div></div>""" % (sdate,
             item.link, stitle, fdesc))
 
+    return msgbody
+
+
+def feed_to_html(feed, items=None):
+    """Форматирование новостей ленты в HTML-документ.
+
+    feed    - экземпляр rssmailfeeds.RSSFeed;
+    items   - список строк с уже свёрстанными записями (см. feed_items_to_html);
+              если None - свёрстываются все записи feed.items."""
+
+    if items is None:
+        items = feed_items_to_html(feed)
+
+    return html_document(u''.join([u'<h2>%s</h2>\n' % feed.title] + items))
+
+
+def digest_to_html(sections):
+    """Форматирование новостей нескольких лент в один HTML-документ
+    (сводку) с оглавлением.
+
+    sections    - список кортежей (лента, записи, HTML записей), см. mail_parts()."""
+
+    msgbody = [u'<h1>%d feed(s), %d new(s)</h1>\n<ul>\n' % (len(sections), sum(map(lambda s: len(s[1]), sections)))]
+
+    for ix, (feed, items, htmls) in enumerate(sections):
+        msgbody.append(u'<li><a href="#feed%d">%s</a> (%d)</li>\n' % (ix, feed.title, len(items)))
+
+    msgbody.append(u'</ul>\n')
+
+    for ix, (feed, items, htmls) in enumerate(sections):
+        msgbody.append(u'<h2><a name="feed%d">%s</a></h2>\n' % (ix, feed.title))
+        msgbody += htmls
+
     return html_document(u''.join(msgbody))
 
 
+def html_size(html, charset):
+    """Размер html в байтах - в кодировке письма charset."""
+
+    return len(html.encode(charset, 'replace'))
+
+
+def mail_parts(feeds, maxsize, charset):
+    """Свёрстывает записи лент из списка feeds и раскладывает их по частям
+    письма так, чтобы HTML каждой части (вместе с обёрткой документа
+    и заголовками лент - см. feed_to_html() и digest_to_html()) был
+    не больше maxsize байт (если maxsize == 0 - без ограничений).
+    Если в списке больше одной ленты - части считаются частями сводки.
+    Размер считается для кодировки письма charset (см. env.mailCharset).
+    Запись, которая сама не влезает в maxsize, попадает в отдельную часть.
+    Возвращает список частей; часть - список кортежей (лента, список записей,
+    список строк с HTML этих записей)."""
+
+    digest = len(feeds) > 1
+
+    # размер части без записей: обёртка документа (у сводки - ещё
+    # и заголовок с оглавлением)...
+    emptysize = html_size(digest_to_html([]) if digest else html_document(u''), charset)
+
+    def section_size(feed):
+        # ...и то, что добавляет каждая лента (заголовок, строка оглавления)
+        return html_size(digest_to_html([(feed, [], [])]) if digest else feed_to_html(feed, []), charset) - emptysize
+
+    parts = []
+    part = []
+    partsize = emptysize
+    # кол-во записей в текущей части
+    partitems = 0
+
+    for feed in feeds:
+        items = []
+        htmls = []
+        part.append((feed, items, htmls))
+
+        ssize = section_size(feed) if maxsize else 0
+        partsize += ssize
+
+        for item, html in zip(feed.items, feed_items_to_html(feed)):
+            if maxsize:
+                isize = html_size(html, charset)
+
+                if partitems and partsize + isize > maxsize:
+                    # начинаем следующую часть
+                    if not items:
+                        # лента не успела попасть в эту часть
+                        part.pop()
+
+                    parts.append(part)
+
+                    items = []
+                    htmls = []
+                    part = [(feed, items, htmls)]
+                    partsize = emptysize + ssize
+                    partitems = 0
+
+                partsize += isize
+                partitems += 1
+
+            items.append(item)
+            htmls.append(html)
+
+    parts.append(part)
+
+    return parts
+
+
+def part_subject_suffix(partno, nparts):
+    return u'' if nparts < 2 else u', part %d/%d' % (partno, nparts)
+
+
+def feed_message_subject(env, feed, partno=1, nparts=1):
+    return u'%s%s (%d%s)%s' % (env.mailSubjectPrefix,
+        feed.title, feed.newItems, part_subject_suffix(partno, nparts),
+        env.mailSubjectSuffix)
+
+
+def digest_message_subject(env, feeds, group, partno=1, nparts=1):
+    return u'%s%s: %d feed(s) (%d%s)%s' % (env.mailSubjectPrefix,
+        group if group else u'Digest', len(feeds),
+        sum(map(lambda f: f.newItems, feeds)), part_subject_suffix(partno, nparts),
+        env.mailSubjectSuffix)
+
+
+class FeedMail():
+    """Метка письма (или части письма) с новостями лент для MailSender:
+    какие ленты в письме и какие записи их истории надо сохранить
+    после отправки."""
+
+    def __init__(self, title, feeds, records):
+        # для лога
+        self.title = title
+        # список экземпляров RSSFeed
+        self.feeds = feeds
+        # словарь, где ключи - адреса лент, а значения - списки
+        # экземпляров historyrecord
+        self.records = records
+
+
+class FeedMailer():
+    """Вёрстка и отправка писем с новостями лент.
+    Отправка - пулом потоков (см. rssmailersender.MailSender),
+    результаты забираются методом results().
+    Если env.settDontSendMail == True - письма только сохраняются
+    в каталог dbgout (если он есть), и новости НЕ считаются отправленными.
+
+    Метки писем (см. MailSender.submit()) - экземпляр FeedMail для письма
+    с новостями (одной ленты или сводки, целиком или части),
+    SpoolEntry для письма из очереди неотправленных, None для письма
+    об ошибках.
+
+    В режиме конвейера (pipeline=True) ленты передаются методом feed_done()
+    по мере загрузки, верстаются в отдельном потоке и сразу ставятся
+    в очередь на отправку, т.е. загрузка и отправка идут одновременно.
+    Очереди между этапами ограничены - если отправка не поспевает,
+    загрузка притормаживается."""
+
+    # ограничение на кол-во лент в очереди на вёрстку и писем в очереди
+    # на отправку - на каждое соединение с SMTP-сервером
+    PIPELINE_QUEUE_SIZE = 4
+
+    def __init__(self, env, pipeline=False):
+        self.env = env
+
+        if env.settDontSendMail:
+            self.debugDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), u'dbgout')
+            if not os.path.isdir(self.debugDir):
+                self.debugDir = None
+        else:
+            self.debugDir = None
+
+        qsize = self.PIPELINE_QUEUE_SIZE * env.mailConnections if pipeline else 0
+
+        # письма отправляются пулом потоков, у каждого - своё
+        # соединение с SMTP-сервером
+        self.sender = MailSender(env, qsize)
+
+        # кол-во частей писем с новостями каждой ленты, результат отправки
+        # которых ещё не учтён (см. part_done())
+        self.feedParts = {}
+
+        if pipeline:
+            self.renderQueue = queue.Queue(qsize)
+            self.renderer = threading.Thread(target=self.__render_thread)
+            self.renderer.start()
+        else:
+            self.renderQueue = None
+            self.renderer = None
+
+    def __render_thread(self):
+        while True:
+            feed = self.renderQueue.get()
+            if feed is None:
+                return
+
+            try:
+                self.send_feed(feed)
+            except Exception as ex:
+                # пусть остальные ленты всё равно отправятся
+                log_exception_info(self.env, sys.exc_info(), str(ex))
+
+    def feed_done(self, feed):
+        """Для режима конвейера: ставит ленту feed в очередь на вёрстку
+        и отправку (если у неё есть новости). Вызывается по завершении
+        загрузки ленты; может вызываться из разных потоков."""
+
+        if feed.error is None and feed.newItems > 0:
+            self.renderQueue.put(feed)
+
+    def render(self, feeds, group=None):
+        """Вёрстка письма с новостями ленты (если в списке feeds одна лента)
+        или письма-сводки (если больше; group - название группы лент).
+        У всех лент списка должен быть один набор получателей.
+        Письмо больше env.mailMaxSize делится на части ("part 1/3"),
+        у каждой части - свои записи истории, которые сохраняются после
+        её отправки.
+        Возвращает список кортежей (письмо, метка FeedMail, получатели)
+        для MailSender.submit_batch()."""
+
+        # HTML в письме кодируется в base64 (строками по 76 символов,
+        # т.е. 77 байт на каждые 57), и у письма есть ещё заголовки
+        maxsize = self.env.mailMaxSize
+        if maxsize:
+            maxsize = max((maxsize - MAIL_HEADERS_SIZE) * 57 // 77, 1)
+
+        parts = mail_parts(feeds, maxsize, self.env.mailCharset)
+        nparts = len(parts)
+        mailto = feeds[0].mailTo
+
+        jobs = []
+
+        for partno, sections in enumerate(parts, 1):
+            if len(feeds) > 1:
+                mbody = digest_to_html(sections)
+                msubj = digest_message_subject(self.env, feeds, group, partno, nparts)
+                mtitle = u'digest of %d feed(s)' % len(feeds)
+            else:
+                mbody = feed_to_html(feeds[0], sections[0][2])
+                msubj = feed_message_subject(self.env, feeds[0], partno, nparts)
+                mtitle = u'feed "%s"' % feeds[0].title
+
+            if nparts > 1:
+                mtitle += u', part %d/%d' % (partno, nparts)
+
+            if self.env.settDontSendMail:
+                if self.debugDir:
+                    with open(os.path.join(self.debugDir, u'debug%.x.html' % hash(msubj)), 'w+', encoding=IOENCODING) as f:
+                        f.write(mbody)
+
+                #!!! при фейковой отправке новость НЕ считаем прочитанной !!!
+                continue
+
+            records = {}
+
+            for feed, items, htmls in sections:
+                records[feed.url] = list(filter(None, map(lambda i: feed.history.newRecords.get(i.guid), items)))
+
+                self.feedParts[feed.url] = self.feedParts.get(feed.url, 0) + 1
+
+            jobs.append((make_message(self.env, msubj, None, mbody, mailto=mailto),
+                FeedMail(mtitle, list(map(lambda s: s[0], sections)), records),
+                mailto))
+
+        return jobs
+
+    def part_done(self, feed):
+        """Учёт отправки (или неудачи) одной из частей письма с новостями
+        ленты feed. Возвращает True, если это была последняя часть."""
+
+        n = self.feedParts[feed.url] - 1
+        self.feedParts[feed.url] = n
+
+        return n == 0
+
+    def send_feed(self, feed):
+        """Вёрстка письма с новостями ленты feed и постановка его
+        в очередь на отправку."""
+
+        self.sender.submit_batch(self.render([feed]))
+
+    def send_digests(self, feeds):
+        """Вёрстка писем-сводок с новостями лент из списка feeds
+        и постановка их в очередь на отправку. На каждую группу лент
+        (RSSFeed.group) с одним набором получателей - одно письмо
+        (или несколько частей, см. render()); лента, оказавшаяся в группе
+        одна, отправляется обычным письмом."""
+
+        groups = {}
+
+        for feed in feeds:
+            groups.setdefault((tuple(feed.mailTo) if feed.mailTo else None, feed.group), []).append(feed)
+
+        for (mailto, group), gfeeds in groups.items():
+            self.sender.submit_batch(self.render(gfeeds, group))
+
+    def send_feeds(self, feeds):
+        """Вёрстка писем с новостями лент из списка feeds и постановка их
+        в очередь на отправку (если env.settDigest - в виде сводок,
+        см. send_digests()), сгруппированными по наборам получателей:
+        письма одной группы уходят подряд через одно соединение.
+        Большие группы делятся на части - чтобы письма расходились
+        по всем соединениям (env.mailConnections), и не длиннее
+        env.mailMaxMessages (после стольких писем соединение всё равно
+        открывается заново)."""
+
+        if self.env.settDigest:
+            self.send_digests(feeds)
+            return
+
+        groups = {}
+
+        for feed in feeds:
+            jobs = self.render([feed])
+            if jobs:
+                # порядок групп - как у лент в списке
+                groups.setdefault(tuple(feed.mailTo) if feed.mailTo else None, []).extend(jobs)
+
+        # на сколько частей делить каждую группу
+        nparts = max(1, self.env.mailConnections // max(1, len(groups)))
+
+        for jobs in groups.values():
+            bsize = -(-len(jobs) // nparts)
+            if self.env.mailMaxMessages:
+                bsize = min(bsize, self.env.mailMaxMessages)
+
+            for ix in range(0, len(jobs), bsize):
+                self.sender.submit_batch(jobs[ix:ix + bsize])
+
+    def send_spooled(self, entry):
+        """Постановка в очередь на отправку письма entry
+        (экземпляр SpoolEntry) из очереди неотправленных писем."""
+
+        if not self.env.settDontSendMail:
+            self.sender.submit(entry.message(), entry, entry.mailTo)
+
+    def send_errors(self, errfeeds):
+        """Отправка письма про ошибки скачивания лент из списка errfeeds."""
+
+        mbody = u'\n'.join(map(lambda f: u'%s (%s): %s error' % (f.title, f.url, f.errortype), errfeeds))
+
+        msubj = u'Error downloading %d feed(s)' % len(errfeeds)
+
+        if self.env.settDontSendMail:
+            if self.debugDir:
+                with open(os.path.join(self.debugDir, u'debug-errors.txt'), 'w+', encoding=IOENCODING) as f:
+                    f.write(mbody)
+        else:
+            self.sender.submit(make_message(self.env, msubj, mbody, None))
+
+    def finish_rendering(self):
+        """Для режима конвейера: дожидается вёрстки всех переданных лент."""
+
+        if self.renderer is not None:
+            self.renderQueue.put(None)
+            self.renderer.join()
+            self.renderer = None
+
+    def results(self):
+        """См. MailSender.results()."""
+
+        self.finish_rendering()
+
+        return self.sender.results()
+
+    def close(self):
+        self.finish_rendering()
+        self.sender.close()
+
+
 def download_feeds(env, feedSources):
     try:
         env.logger.info(u'* beginning downloads')
 
-        feeds = load_feeds(env, feedSources)
+        relocate_feed_files(env, feedSources)
 
         sendCount = 0
+        emmode = u'simulation' if env.settDontSendMail else u'real'
+
+        if env.settSpool:
+            spool = MailSpool(env.spoolDir)
+            spool.load()
+
+            # новости из неотправленных писем не должны считаться новыми,
+            # пока письма не отправлены
+            for feed in feedSources:
+                feed.history.add_pending(spool.pending_records(feed.url))
+        else:
+            spool = None
 
-        if feeds:
-            if env.settDontSendMail:
-                ddir = os.path.join(os.path.dirname(os.path.abspath(__file__)), u'dbgout')
-                if not os.path.isdir(ddir):
-                    ddir = None
-                emmode = u'simulation'
+        feedsByUrl = dict(map(lambda f: (f.url, f), feedSources))
+        # адреса лент, часть новостей которых не отправлена
+        incomplete = set()
+
+        # для сводок нужны все ленты сразу
+        pipeline = env.settPipeline and not env.settDigest
+
+        dltime = time()
+        mailer = FeedMailer(env, pipeline)
+        try:
+            if spool is not None and spool.entries:
+                spooled = spool.due_entries()
+                env.logger.info(u'%d email(s) in spool, %d to be sent' % (len(spool.entries), len(spooled)))
+
+                for entry in spooled:
+                    mailer.send_spooled(entry)
+
+            if pipeline:
+                # письма отправляются по мере загрузки лент
+                env.logger.info(u'sending emails (%s, pipelined)' % emmode)
+
+                feeds = load_feeds(env, feedSources, mailer.feed_done)
+
+                # письма с новостями лент должны быть в очереди раньше
+                # письма про ошибки (и до того, как забираются результаты)
+                mailer.finish_rendering()
             else:
-                ddir = None
-                emmode = u'real'
+                feeds = load_feeds(env, feedSources)
 
-            env.logger.info(u'sending emails (%s)' % emmode)
+                env.logger.info(u'sending emails (%s)' % emmode)
 
-            dltime = time()
-            try:
-                errfeeds = []
+                dltime = time()
+                # шлём обычным образом письма со скачанными лентами
+                mailer.send_feeds(filter(lambda f: f.error is None and f.newItems > 0, feeds))
 
-                for feed in feeds:
-                    # шлём обычным образом письма со скачанными лентами
-                    if feed.error:
-                        errfeeds.append(feed)
-                    elif feed.newItems > 0:
-                        mbody = feed_to_html(feed)
+            errfeeds = list(filter(lambda f: f.error, feeds))
 
-                        msubj = u'%s%s (%d)%s' % (env.mailSubjectPrefix,
-                                            feed.title, feed.newItems,
-                                            env.mailSubjectSuffix)
+            if errfeeds and env.settSendErrorMail:
+                # шлём письмо про ошибки скачивания
+                mailer.send_errors(errfeeds)
 
-                        if env.settDontSendMail:
-                            if ddir:
-                                with open(os.path.join(ddir, u'debug%.x.html' % hash(msubj)), 'w+', encoding=IOENCODING) as f:
-                                    f.write(mbody)
+            # историю ленты сохраняем только после того,
+            # как письмо с ней принято сервером
+            for msg, tag, mailIsSent in mailer.results():
+                if isinstance(tag, SpoolEntry):
+                    # письмо из очереди неотправленных
+                    mtitle = u'spooled email %s' % tag.name
 
-                            mailIsSent = False #!!! при фейковой отправке новость НЕ считаем прочитанной !!!
-                        else:
-                            mailIsSent = send_message(env, msubj, None, mbody)
+                    if not mailIsSent:
+                        spool.defer(tag)
+                        env.logger.error(u'%s: email is not sent, attempt %d' % (mtitle, tag.attempts))
+                        continue
+
+                    env.logger.debug(u'%s: email sent' % mtitle)
+                    sendCount += 1
 
-                        if mailIsSent:
-                            sendCount += 1
-                            feed.save_guids()
+                    for url, records in tag.feeds.items():
+                        feed = feedsByUrl.get(url)
 
-                if errfeeds and env.settSendErrorMail:
-                    # шлём письмо про ошибки скачивания
-                    mbody = u'\n'.join(map(lambda f: u'%s (%s): %s error' % (f.title, f.url, f.errortype), errfeeds))
+                        if feed is not None:
+                            feed.history.save(records)
+                        else:
+                            env.logger.warning(u'%s: feed %s is not found, history is not saved' % (mtitle, url))
 
-                    msubj = u'Error downloading %d feed(s)' % len(errfeeds)
+                    spool.remove(tag)
+                    continue
 
-                    if env.settDontSendMail:
-                        if ddir:
-                            with open(os.path.join(ddir, u'debug-errors.txt'), 'w+', encoding=IOENCODING) as f:
-                                f.write(mbody)
+                if tag is None:
+                    if mailIsSent:
+                        env.logger.debug(u'error report: email sent')
                     else:
-                        send_message(env, msubj, mbody, None)
+                        env.logger.error(u'error report: email is not sent')
+                    continue
+
+                if not mailIsSent:
+                    if spool is not None:
+                        # письмо откладываем до следующего запуска, а записи
+                        # истории сохраним после его отправки
+                        spool.store(msg, tag.records, tag.feeds[0].mailTo)
 
-            finally:
-                dltime = time() - dltime
+                        env.logger.error(u'%s: email is not sent, queued to spool' % tag.title)
+                    else:
+                        env.logger.error(u'%s: email is not sent' % tag.title)
 
-                if sendCount:
-                    lmsg = u'mail transferring time is %d sec.' % dltime
+                        incomplete.update(map(lambda f: f.url, tag.feeds))
                 else:
-                    lmsg = u'no mail sent'
-                env.logger.info(lmsg)
+                    env.logger.debug(u'%s: email sent' % tag.title)
+                    sendCount += 1
+
+                    for feed in tag.feeds:
+                        feed.history.save(tag.records[feed.url])
+
+                # валидаторы - только когда все части писем с новостями ленты
+                # отправлены (или отложены), иначе при следующей загрузке
+                # будет "304 Not Modified", и неотправленные новости потеряются
+                for feed in tag.feeds:
+                    if mailer.part_done(feed) and feed.url not in incomplete:
+                        feed.save_validators()
+
+        finally:
+            mailer.close()
+
+            dltime = time() - dltime
+
+            if sendCount:
+                lmsg = u'mail transferring time is %d sec.' % dltime
+            else:
+                lmsg = u'no mail sent'
+            env.logger.info(lmsg)
+
+        # дожидаемся фонового уплотнения историй, если оно было затеяно
+        historyCompactor.wait()
 
         env.logger.info(u'* end downloads')
 
@@ -337,6 +770,38 @@ def delete_feeds(env, feedSources, opts):
     print('%s feed(s) deleted' % ('no' if not ndel else '%d' % ndel))
 
 
+def migrate_history(env, feedSources):
+    """Перенос истории лент из текстовых файлов в общую БД sqlite3."""
+
+    if not feedSources:
+        print('No feeds. Nothing to migrate')
+        exit(1)
+
+    relocate_feed_files(env, feedSources)
+
+    db = open_history_db(env.historyDBFileName)
+
+    nmigrated = 0
+    for feed in feedSources:
+        # у ленты, история которой ещё не уплотнялась, есть только журнал;
+        # отсутствующие файлы при загрузке пропускаются
+        src = FileFeedHistory(feed.guidListFileName)
+        src.load()
+
+        records = list(src.records())
+        if not records:
+            continue
+
+        dst = SQLiteFeedHistory(db, feed.url)
+        dst.load()
+        dst.save(records)
+
+        nmigrated += 1
+
+    env.logger.info(u'history of %d feed(s) imported into %s' % (nmigrated, env.historyDBFileName))
+    print('%s feed(s) migrated' % ('no' if not nmigrated else '%d' % nmigrated))
+
+
 def send_email(env, opts):
     nopts = len(opts)
 
@@ -385,6 +850,8 @@ def main():
             set_longdesc(env, feedSources, opts, False)
         elif env.workMode == env.WORK_MODE_LONG:
             set_longdesc(env, feedSources, opts, True)
+        elif env.workMode == env.WORK_MODE_MIGRATE_HISTORY:
+            migrate_history(env, feedSources)
 
         return 0
 
@@ -37,6 +37,48 @@ DOWNLOAD_TIMEOUT = 10
 DOWNLOAD_TIMEOUT_MIN = 1
 DOWNLOAD_TIMEOUT_MAX = 60
 DOWNLOAD_STREAMS = 10
+DOWNLOAD_STREAMS_MAX = 128
+# с asyncio ограничение на кол-во потоков не действует
+DOWNLOAD_STREAMS_MAX_ASYNC = 4096
+
+# качалки лент (см. rssmailerfeeds.make_downloader())
+DOWNLOADER_WGET, DOWNLOADER_BUILTIN = range(2)
+DOWNLOADERS = {u'wget':DOWNLOADER_WGET, u'builtin':DOWNLOADER_BUILTIN}
+
+# движки загрузки (см. rssmailerfeeds.load_feeds())
+ENGINE_THREADS, ENGINE_ASYNCIO = range(2)
+ENGINES = {u'threads':ENGINE_THREADS, u'asyncio':ENGINE_ASYNCIO}
+
+# хранилища истории лент (см. rssmailerhistory.feed_history())
+HISTORY_FILES, HISTORY_SQLITE = range(2)
+HISTORIES = {u'files':HISTORY_FILES, u'sqlite':HISTORY_SQLITE}
+
+# способы доставки писем (см. rssmailersender.mail_session())
+MAIL_DELIVERY_SMTP, MAIL_DELIVERY_MAILDIR, MAIL_DELIVERY_MBOX,\
+MAIL_DELIVERY_LMTP, MAIL_DELIVERY_SENDMAIL = range(5)
+MAIL_DELIVERIES = {u'smtp':MAIL_DELIVERY_SMTP, u'maildir':MAIL_DELIVERY_MAILDIR, u'mbox':MAIL_DELIVERY_MBOX,
+    u'lmtp':MAIL_DELIVERY_LMTP, u'sendmail':MAIL_DELIVERY_SENDMAIL}
+# почтовые ящики по умолчанию для локальной доставки
+MAIL_MAILBOXES = {MAIL_DELIVERY_MAILDIR:u'~/Maildir', MAIL_DELIVERY_MBOX:u'~/mbox'}
+# порт LMTP-сервера по умолчанию (если в параметре lmtp не указан)
+MAIL_LMTP_PORT = 2003
+# команда для delivery = sendmail: письмо передаётся ей в stdin,
+# получатели берутся из заголовков письма
+MAIL_SENDMAIL_COMMAND = u'/usr/sbin/sendmail -t -oi'
+# сколько ждать завершения sendmail (в секундах)
+MAIL_SENDMAIL_TIMEOUT = 60
+
+# ограничение размера письма с новостями (в килобайтах), см. rssmailer.mail_parts()
+MAIL_MAX_SIZE = 2048
+# примерный размер заголовков письма с новостями и его части с HTML
+# (в байтах) - при делении письма на части он тоже учитывается
+MAIL_HEADERS_SIZE = 1024
+
+# писем на одно соединение с SMTP-сервером (см. rssmailersender.SMTPSession)
+MAIL_MAX_MESSAGES = 50
+# одновременных соединений с SMTP-сервером (см. rssmailersender.MailSender)
+MAIL_CONNECTIONS = 1
+MAIL_CONNECTIONS_MAX = 16
 
 
 MAX_SHORT_DESCRIPTION_CHARS = 512
@@ -45,18 +87,94 @@ MAX_LONG_DESCRIPTION_CHARS = 131072
 
 CONFIG_EXAMPLE = u"""[settings]
 ; количество одновременных загрузок (если не указано - %d)
+; не более %d, для engine = asyncio - не более %d
 downloads = 10
 
+; как качать ленты:
+; threads   - по отдельному потоку на каждую загрузку (по умолчанию)
+; asyncio   - все загрузки в одном потоке, с помощью asyncio
+;             (встроенной качалкой, параметр downloader не учитывается)
+engine = threads
+
+; где хранить историю (уже отправленные записи) лент:
+; files     - в текстовых файлах, по файлу на ленту (по умолчанию)
+; sqlite    - в общей БД sqlite3 (файл history.sqlite);
+;             перенести туда историю из файлов можно командой migrate-history
+history = files
+
+; ограничения на размер истории каждой ленты (0 - без ограничений):
+; history-days  - забывать записи, появившиеся более указанного
+;                 кол-ва дней назад
+; history-max   - хранить не более указанного кол-ва самых свежих записей
+; записи, которые всё ещё есть в ленте, не забываются.
+; ограничения можно переопределить для отдельной ленты в feeds.cfg
+; теми же параметрами
+history-days = 0
+history-max = 0
+
+; хранить ли для проверок историю лент из файлов (history = files)
+; в компактном виде - в виде отсортированных массивов дайджестов
+; в файлах *.guids.idx, которые не читаются, а отображаются в память;
+; экономит память и время загрузки при больших историях
+; no/yes    - нет (по умолчанию)/да
+history-compact = no
+
+; раскладывать ли файлы лент (историю и т.п.) по подкаталогам вида
+; feeds/ab/cd/ (полезно при тысячах лент); существующие файлы переносятся
+; на новое место автоматически (командами download и migrate-history)
+; no/yes    - нет (по умолчанию)/да
+feed-shards = no
+
+; чем качать ленты:
+; wget      - внешней программой wget (по умолчанию)
+; builtin   - встроенной качалкой (без запуска внешних процессов,
+;             с повторным использованием соединений)
+downloader = wget
+
 ; отправлять ли письма об ошибках скачивания лент
 ; no/yes    - нет/да
 mail-errors = yes
 
+; отправлять ли письма по мере загрузки лент (конвейером), не дожидаясь
+; окончания всех загрузок
+; no/yes    - нет (по умолчанию)/да
+pipeline = no
+
+; отправлять ли новости всех лент одним письмом-сводкой (с оглавлением)
+; вместо отдельного письма на каждую ленту; сводки делаются по группам
+; лент (параметр group в feeds.cfg) и наборам получателей (параметр to);
+; с digest = yes режим конвейера (pipeline) не используется
+; no/yes    - нет (по умолчанию)/да
+digest = no
+
+; сохранять ли неотправленные письма в очередь (каталог spool), чтобы
+; отправить их при следующих запусках; пока письмо в очереди, новости
+; из него не считаются новыми и не отправляются повторно
+; no/yes    - нет/да (по умолчанию)
+spool = yes
+
 [mail]
 ; адрес отправителя
 from = sender@someserver.net
 ; адреса получателей, не менее одного, разделяются запятыми
 ; если получатели не указаны - отправитель будет слать самому себе
 to = stinky@shitty.poo, cthoolhu@oldones.org
+; способ доставки писем:
+; smtp      - через SMTP-сервер (по умолчанию)
+; maildir   - запись в локальный каталог Maildir (параметр mailbox)
+; mbox      - дописывание в локальный файл mbox (параметр mailbox)
+; lmtp      - через LMTP-сервер локального MTA (параметр lmtp)
+; sendmail  - передачей каждого письма программе, совместимой
+;             с "sendmail -t" (параметр sendmail)
+delivery = smtp
+; для delivery = maildir или mbox: путь к каталогу Maildir или к файлу mbox
+; (если не указан - ~/Maildir или ~/mbox соответственно)
+;mailbox = ~/Maildir
+; для delivery = lmtp: путь к unix-сокету или адрес LMTP-сервера и, через
+; двоеточие, порт (если не указан - %d); адрес IPv6 - в квадратных скобках
+;lmtp = /var/run/dovecot/lmtp
+; для delivery = sendmail: команда (если не указана - %s)
+;sendmail = %s
 ; адрес SMTP-сервера (и при необходимости порт)
 smtp = smtp.someserver.net:587
 ; логин (если нужна аутентификация)
@@ -71,13 +189,54 @@ login = username
 password = PaSsWoRd
 ; использовать ли TLS
 tls = yes
+; сколько писем отправлять через одно соединение с SMTP-сервером,
+; после чего соединение открывается заново (если не указано - %d;
+; 0 - без ограничений)
+max-messages = %d
+; примерный максимальный размер письма с новостями в килобайтах (если
+; не указан - %d; 0 - без ограничений); если новостей больше, они
+; отправляются несколькими письмами ("part 1/3"), и записи истории
+; сохраняются после отправки каждой части
+max-size = %d
+; кол-во одновременных соединений с SMTP-сервером (письма отправляются
+; параллельно); если не указано - %d, не более %d
+connections = %d
 ; кодировка писем. если не указана - будет использована UTF-8
 charset = utf-8
 ; текст, добавляемый в начале заголовков всех писем
 subject-prefix =
 ; текст, добавляемый в конце заголовков всех писем
 subject-suffix =
-""" % DOWNLOAD_STREAMS
+""" % (DOWNLOAD_STREAMS, DOWNLOAD_STREAMS_MAX, DOWNLOAD_STREAMS_MAX_ASYNC,
+    MAIL_LMTP_PORT,
+    MAIL_SENDMAIL_COMMAND, MAIL_SENDMAIL_COMMAND,
+    MAIL_MAX_MESSAGES, MAIL_MAX_MESSAGES,
+    MAIL_MAX_SIZE, MAIL_MAX_SIZE,
+    MAIL_CONNECTIONS, MAIL_CONNECTIONS_MAX, MAIL_CONNECTIONS)
+
+
+def parse_lmtp_address(addr):
+    """Разбирает значение параметра lmtp: путь к unix-сокету или адрес
+    с необязательным портом ("host", "host:port", "[ipv6]:port").
+    Возвращает кортеж из двух элементов - адреса (или пути) и порта.
+    В случае неправильного порта генерирует исключение ValueError."""
+
+    if not addr or addr.startswith(u'/'):
+        return (addr, MAIL_LMTP_PORT)
+
+    host, sep, port = addr.rpartition(u':')
+
+    # двоеточия внутри адреса IPv6 без скобок - не порт
+    if not sep or (u':' in host and not host.endswith(u']')):
+        host = addr
+        port = None
+    elif not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(u'config error: invalid LMTP port "%s"' % port)
+
+    if host.startswith(u'[') and host.endswith(u']'):
+        host = host[1:-1]
+
+    return (host, MAIL_LMTP_PORT if port is None else int(port))
 
 
 class CfgParser(RawConfigParser):
@@ -179,7 +338,7 @@ class RSSMailerEnvironment():
 
     WORK_MODE_DOWNLOAD, WORK_MODE_LIST, WORK_MODE_DISABLE,\
     WORK_MODE_ENABLE, WORK_MODE_ADD, WORK_MODE_DELETE, WORK_MODE_SENDMAIL,\
-    WORK_MODE_SHORT, WORK_MODE_LONG = range(9)
+    WORK_MODE_SHORT, WORK_MODE_LONG, WORK_MODE_MIGRATE_HISTORY = range(10)
 
     __WORK_MODE_CMDS = {'download':WORK_MODE_DOWNLOAD,
         'list':WORK_MODE_LIST,
@@ -189,15 +348,26 @@ class RSSMailerEnvironment():
         'delete':WORK_MODE_DELETE,
         'sendmail':WORK_MODE_SENDMAIL,
         'shortdesc':WORK_MODE_SHORT,
-        'longdesc':WORK_MODE_LONG}
+        'longdesc':WORK_MODE_LONG,
+        'migrate-history':WORK_MODE_MIGRATE_HISTORY}
 
     SEND_ERROR_MAIL_DEFAULT = True
 
     def __init__(self):
         # defaults
         self.settDownloads = DOWNLOAD_STREAMS
+        self.settDownloader = DOWNLOADER_WGET
+        self.settEngine = ENGINE_THREADS
+        self.settHistory = HISTORY_FILES
+        self.settHistoryDays = 0
+        self.settHistoryMax = 0
+        self.settHistoryCompact = False
+        self.settFeedShards = False
 
         self.settSendErrorMail = self.SEND_ERROR_MAIL_DEFAULT
+        self.settPipeline = False
+        self.settSpool = True
+        self.settDigest = False
 
         self.mailFrom = None
         self.mailTo = []
@@ -205,6 +375,14 @@ class RSSMailerEnvironment():
         self.mailLogin = None
         self.mailPassword = None
         self.mailTLS = False
+        self.mailMaxMessages = MAIL_MAX_MESSAGES
+        self.mailMaxSize = MAIL_MAX_SIZE * 1024
+        self.mailConnections = MAIL_CONNECTIONS
+        self.mailDelivery = MAIL_DELIVERY_SMTP
+        self.mailMailbox = None
+        self.mailLMTPHost = None
+        self.mailLMTPPort = MAIL_LMTP_PORT
+        self.mailSendmail = MAIL_SENDMAIL_COMMAND
         self.mailCharset = 'utf-8'
         self.mailSubjectPrefix = u''
         self.mailSubjectSuffix = u''
@@ -217,6 +395,9 @@ class RSSMailerEnvironment():
         self.workDir = None
         self.feedDir = None
         self.feedListFileName = None
+        self.feedTimesFileName = None
+        self.historyDBFileName = None
+        self.spoolDir = None
         self.configFileName = None
         self.logFileName = None
 
@@ -228,8 +409,18 @@ class RSSMailerEnvironment():
         # для отладки
         return(u'''* %s: *
 self.settDownloads = %s
+self.settDownloader = %s
+self.settEngine = %s
+self.settHistory = %s
+self.settHistoryDays = %s
+self.settHistoryMax = %s
+self.settHistoryCompact = %s
+self.settFeedShards = %s
 
 self.settSendErrorMail = %s
+self.settPipeline = %s
+self.settSpool = %s
+self.settDigest = %s
 
 self.mailFrom = %s
 self.mailTo = %s
@@ -237,6 +428,14 @@ self.mailHost = %s
 self.mailLogin = %s
 self.mailPassword = %s
 self.mailTLS = %s
+self.mailMaxMessages = %s
+self.mailMaxSize = %s
+self.mailConnections = %s
+self.mailDelivery = %s
+self.mailMailbox = %s
+self.mailLMTPHost = %s
+self.mailLMTPPort = %s
+self.mailSendmail = %s
 self.mailCharset = %s
 self.mailSubjectPrefix = %s
 self.mailSubjectSuffix = %s
@@ -249,18 +448,39 @@ self.settLocalConfig = %s
 self.workDir = %s
 self.feedDir = %s
 self.feedListFileName = %s
+self.feedTimesFileName = %s
+self.historyDBFileName = %s
+self.spoolDir = %s
 self.configFileName = %s
 self.logFileName = %s
 
 self.workMode = %s''' % (self.__class__.__name__,
         self.settDownloads,
+        self.settDownloader,
+        self.settEngine,
+        self.settHistory,
+        self.settHistoryDays,
+        self.settHistoryMax,
+        self.settHistoryCompact,
+        self.settFeedShards,
         self.settSendErrorMail,
+        self.settPipeline,
+        self.settSpool,
+        self.settDigest,
         self.mailFrom,
         self.mailTo,
         self.mailHost,
         self.mailLogin,
         self.mailPassword,
         self.mailTLS,
+        self.mailMaxMessages,
+        self.mailMaxSize,
+        self.mailConnections,
+        self.mailDelivery,
+        self.mailMailbox,
+        self.mailLMTPHost,
+        self.mailLMTPPort,
+        self.mailSendmail,
         self.mailCharset,
         self.mailSubjectPrefix,
         self.mailSubjectSuffix,
@@ -271,6 +491,9 @@ self.workMode = %s''' % (self.__class__.__name__,
         self.workDir,
         self.feedDir,
         self.feedListFileName,
+        self.feedTimesFileName,
+        self.historyDBFileName,
+        self.spoolDir,
         self.configFileName,
         self.logFileName,
         self.workMode))
@@ -285,6 +508,9 @@ self.workMode = %s''' % (self.__class__.__name__,
 
         self.feedDir = os.path.join(self.workDir, u'feeds')
         self.feedListFileName = os.path.join(self.workDir, u'feeds.cfg')
+        self.feedTimesFileName = os.path.join(self.workDir, u'feedtimes.dat')
+        self.historyDBFileName = os.path.join(self.workDir, u'history.sqlite')
+        self.spoolDir = os.path.join(self.workDir, u'spool')
         self.configFileName = os.path.join(self.workDir, u'config.cfg')
         self.logFileName = os.path.join(self.workDir, u'rssmailer.log')
 
@@ -308,18 +534,39 @@ self.workMode = %s''' % (self.__class__.__name__,
         cfg.load()
 
         #
-        self.settDownloads = cfg.get_int(self.CS_SETTINGS, u'downloads', DOWNLOAD_STREAMS, 1, 128)
+        self.settEngine = cfg.get_option(self.CS_SETTINGS, u'engine', ENGINES, ENGINE_THREADS)
+        self.settDownloads = cfg.get_int(self.CS_SETTINGS, u'downloads', DOWNLOAD_STREAMS, 1,
+            DOWNLOAD_STREAMS_MAX_ASYNC if self.settEngine == ENGINE_ASYNCIO else DOWNLOAD_STREAMS_MAX)
+        self.settDownloader = cfg.get_option(self.CS_SETTINGS, u'downloader', DOWNLOADERS, DOWNLOADER_WGET)
+        self.settHistory = cfg.get_option(self.CS_SETTINGS, u'history', HISTORIES, HISTORY_FILES)
+        self.settHistoryDays = cfg.get_int(self.CS_SETTINGS, u'history-days', 0, 0)
+        self.settHistoryMax = cfg.get_int(self.CS_SETTINGS, u'history-max', 0, 0)
+        self.settHistoryCompact = cfg.get_bool(self.CS_SETTINGS, u'history-compact')
+        self.settFeedShards = cfg.get_bool(self.CS_SETTINGS, u'feed-shards')
 
         self.settSendErrorMail = cfg.get_bool(self.CS_SETTINGS, u'mail-errors', self.SEND_ERROR_MAIL_DEFAULT)
+        self.settPipeline = cfg.get_bool(self.CS_SETTINGS, u'pipeline')
+        self.settSpool = cfg.get_bool(self.CS_SETTINGS, u'spool', True)
+        self.settDigest = cfg.get_bool(self.CS_SETTINGS, u'digest')
 
         #
         self.mailFrom = cfg.get_str(self.CS_MAIL, u'from')
         self.mailTo = list(filter(None, map(lambda t: t.strip(), cfg.get_str(self.CS_MAIL, u'to', u'').split(u','))))
 
+        self.mailDelivery = cfg.get_option(self.CS_MAIL, u'delivery', MAIL_DELIVERIES, MAIL_DELIVERY_SMTP)
+        self.mailMailbox = cfg.get_str(self.CS_MAIL, u'mailbox', MAIL_MAILBOXES.get(self.mailDelivery))
+        if self.mailMailbox:
+            self.mailMailbox = os.path.expanduser(self.mailMailbox)
+        self.mailLMTPHost = cfg.get_str(self.CS_MAIL, u'lmtp')
+        self.mailSendmail = cfg.get_str(self.CS_MAIL, u'sendmail', MAIL_SENDMAIL_COMMAND)
+
         self.mailHost = cfg.get_str(self.CS_MAIL, u'smtp')
         self.mailLogin = cfg.get_str(self.CS_MAIL, u'login')
         self.mailPassword = cfg.get_str(self.CS_MAIL, u'password')
         self.mailTLS = cfg.get_bool(self.CS_MAIL, u'tls')
+        self.mailMaxMessages = cfg.get_int(self.CS_MAIL, u'max-messages', MAIL_MAX_MESSAGES, 0)
+        self.mailMaxSize = cfg.get_int(self.CS_MAIL, u'max-size', MAIL_MAX_SIZE, 0) * 1024
+        self.mailConnections = cfg.get_int(self.CS_MAIL, u'connections', MAIL_CONNECTIONS, 1, MAIL_CONNECTIONS_MAX)
         self.mailCharset = cfg.get_str(self.CS_MAIL, u'charset', IOENCODING)
 
         self.mailSubjectPrefix = cfg.get_str(self.CS_MAIL, u'subject-prefix').lstrip()
@@ -331,9 +578,14 @@ self.workMode = %s''' % (self.__class__.__name__,
         if not self.mailTo:
             self.mailTo = [self.mailFrom]
 
-        if not self.mailHost:
+        if not self.mailHost and self.mailDelivery == MAIL_DELIVERY_SMTP:
             raise ValueError(u'config error: SMTP address not specified')
 
+        if not self.mailLMTPHost and self.mailDelivery == MAIL_DELIVERY_LMTP:
+            raise ValueError(u'config error: LMTP address not specified')
+
+        self.mailLMTPHost, self.mailLMTPPort = parse_lmtp_address(self.mailLMTPHost)
+
         if not self.mailLogin:
             if self.mailPassword:
                 self.mailLogin = self.mailFrom
@@ -370,6 +622,7 @@ sendmail <parameters>   - send email message; parameters are: subject body [atta
                           subject - message subject
                           body - message text
                           attach - list of file names
+migrate-history         - import history from feed files into history.sqlite
 
 -s, --syslog            - copy log output (stderr) to syslog
 -d, --debug             - log debug messages
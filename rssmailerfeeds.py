@@ -21,28 +21,42 @@
     along with RSSMailer.  If not, see <http://www.gnu.org/licenses/>."""
 
 
-from urllib.parse import urlsplit
+from urllib.parse import urlsplit, urljoin
 from urllib.request import urlopen, URLError
-from http.client import HTTPException
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
 from socket import error as socket_error
+import ssl
+import zlib
 from html.parser import HTMLParser
-from xml.sax import parse as xml_parse, SAXParseException
+from xml.sax import make_parser as xml_make_parser, SAXParseException
 import rssparser
 from configparser import RawConfigParser
 import re
 from time import time, sleep
 import subprocess
 import threading
-from tempfile import NamedTemporaryFile
+import queue
+import asyncio
+from tempfile import TemporaryFile
 from hashlib import md5
 from collections import namedtuple
+from functools import lru_cache
 
 from rssmailerconfig import *
+from rssmailerhistory import *
 
 
 MAX_FEED_FNAME_SIZE = 64
 _FNAME_HASH_EDGE = MAX_FEED_FNAME_SIZE - 8
 
+# суффиксы файлов ленты в каталоге feedDir
+FEED_FILE_GUIDS = u'.guids'
+FEED_FILE_VALIDATORS = u'.validators'
+FEED_FILE_SUFFIXES = (FEED_FILE_GUIDS,
+    FEED_FILE_GUIDS + FileFeedHistory.JOURNAL_SUFFIX,
+    FEED_FILE_GUIDS + CompactFileFeedHistory.INDEX_SUFFIX,
+    FEED_FILE_VALIDATORS)
+
 
 
 def url_to_file_name(url):
@@ -63,93 +77,957 @@ def url_to_file_name(url):
 
     s = u''.join(map(url_char, u''.join(filter(None, (p.netloc, p.path, p.query)))))
     if len(s) > MAX_FEED_FNAME_SIZE:
-        s = s[:_FNAME_HASH_EDGE] + u'%x' % hash(s)
+        # хэш должен быть одинаковым при каждом запуске,
+        # так что встроенный hash() не годится
+        s = s[:_FNAME_HASH_EDGE] + md5(s.encode(IOENCODING)).hexdigest()[:MAX_FEED_FNAME_SIZE - _FNAME_HASH_EDGE]
 
     return s
 
 
-def download_url(url, timeout, fstdout, fstderr):
+_LEGACY_FNAME_RX = re.compile(r'^(.{%d})-?[0-9a-f]+%s$' % (_FNAME_HASH_EDGE, re.escape(FEED_FILE_GUIDS)))
+
+
+def legacy_feed_file_names(feeddir):
+    """Ищет в каталоге feeddir файлы, созданные старыми версиями
+    для длинных URL: их имена - первые _FNAME_HASH_EDGE символов нынешнего
+    имени (см. url_to_file_name) и хэш от встроенного hash(), который
+    менялся при каждом запуске, так что полностью старое имя не восстановить.
+    Возвращает словарь, где ключи - первые _FNAME_HASH_EDGE символов имени,
+    а значения - списки полных имён (без суффиксов) файлов истории,
+    начиная с самого свежего."""
+
+    legacy = {}
+
+    for fname in os.listdir(feeddir):
+        rm = _LEGACY_FNAME_RX.match(fname)
+        # имена нынешнего вида (с 8 цифрами хэша) - не наши
+        if rm and len(fname) != MAX_FEED_FNAME_SIZE + len(FEED_FILE_GUIDS):
+            legacy.setdefault(rm.group(1), []).append(fname[:-len(FEED_FILE_GUIDS)])
+
+    for names in legacy.values():
+        names.sort(key=lambda n: os.path.getmtime(os.path.join(feeddir, n + FEED_FILE_GUIDS)), reverse=True)
+
+    return legacy
+
+
+def feed_file_path(env, fbasename, sharded):
+    """Возвращает путь (без суффикса) к файлам ленты с именем fbasename
+    в каталоге env.feedDir. Если sharded == True - в двухуровневом
+    подкаталоге вида "ab/cd" (по хэшу имени), чтобы в одном каталоге
+    не скапливались десятки тысяч файлов."""
+
+    if not sharded:
+        return os.path.join(env.feedDir, fbasename)
+
+    h = md5(fbasename.encode(IOENCODING)).hexdigest()
+    return os.path.join(env.feedDir, h[:2], h[2:4], fbasename)
+
+
+def make_file_dir(fname):
+    """Создаёт (если его нет) каталог для файла fname - подкаталоги
+    лент создаются только тогда, когда в них есть что записать."""
+
+    fdir = os.path.dirname(fname)
+    if fdir and not os.path.isdir(fdir):
+        os.makedirs(fdir, exist_ok=True)
+
+
+def feed_files_exist(fpath):
+    for suffix in FEED_FILE_SUFFIXES:
+        if os.path.exists(fpath + suffix):
+            return True
+
+    return False
+
+
+def move_feed_files(env, srcpath, dstpath):
+    """Перемещает существующие файлы ленты из srcpath в dstpath
+    (пути без суффиксов)."""
+
+    make_file_dir(dstpath)
+
+    for suffix in FEED_FILE_SUFFIXES:
+        if os.path.exists(srcpath + suffix):
+            os.replace(srcpath + suffix, dstpath + suffix)
+
+    env.logger.info(u'feed files "%s" moved to "%s"' % (srcpath, dstpath))
+
+
+def feed_file_base(env, url):
+    """Возвращает путь (без суффикса, см. FEED_FILE_SUFFIXES) к файлам
+    ленты с адресом url - в соответствии с настройкой env.settFeedShards.
+    Ни файлов, ни каталогов не трогает (см. relocate_feed_files)."""
+
+    return feed_file_path(env, url_to_file_name(url), env.settFeedShards)
+
+
+def relocate_feed_files(env, feeds):
+    """Переносит на нынешнее место (см. feed_file_base) файлы лент
+    из списка feeds (экземпляров RSSFeed), оставшиеся на старом: в каталоге
+    без подкаталогов или наоборот (если менялась настройка feed-shards),
+    либо под именами, созданными старыми версиями для длинных URL
+    (см. legacy_feed_file_names).
+    Вызывается только командами, которые работают с файлами лент (download
+    и т.п.), а не при каждом запуске.
+    Файлы со старыми именами переносятся, только если их началу имени
+    соответствует ровно одна лента из feeds (считая и отключенные) -
+    иначе не понять, чья это история."""
+
+    legacy = None
+
+    # адреса лент с длинными URL по началу имени
+    prefixurls = {}
+    for feed in feeds:
+        fbasename = url_to_file_name(feed.url)
+        if len(fbasename) == MAX_FEED_FNAME_SIZE:
+            prefixurls.setdefault(fbasename[:_FNAME_HASH_EDGE], set()).add(feed.url)
+
+    for feed in feeds:
+        if feed_files_exist(feed.fileBase):
+            continue
+
+        fbasename = url_to_file_name(feed.url)
+
+        oldpath = feed_file_path(env, fbasename, not env.settFeedShards)
+        if feed_files_exist(oldpath):
+            move_feed_files(env, oldpath, feed.fileBase)
+            continue
+
+        if len(fbasename) != MAX_FEED_FNAME_SIZE:
+            continue
+
+        if legacy is None:
+            legacy = legacy_feed_file_names(env.feedDir)
+
+        prefix = fbasename[:_FNAME_HASH_EDGE]
+        names = legacy.get(prefix)
+        if not names:
+            continue
+
+        if len(prefixurls[prefix]) > 1:
+            env.logger.warning(u'feed "%s": old history file "%s" may belong to another feed with similar URL, not moved' % (feed.title, names[0]))
+            continue
+
+        move_feed_files(env, os.path.join(env.feedDir, names[0]), feed.fileBase)
+
+
+# валидаторы для условного GET (If-None-Match/If-Modified-Since)
+http_validators = namedtuple('http_validators', 'etag lastmodified')
+# etag          - значение заголовка ETag (или пустая строка)
+# lastmodified  - значение заголовка Last-Modified (или пустая строка)
+
+# результат download_url()
+download_result = namedtuple('download_result', 'error notmodified validators')
+# error         - None или строка с сообщением об ошибке
+# notmodified   - True, если сервер ответил 304 (содержимое не изменилось)
+# validators    - экземпляр http_validators из последнего ответа сервера
+#                 (или None, если заголовки получить не удалось)
+
+
+class FeedParsingStopped(Exception):
+    """Исключение, которым RSSFeed.flush_item() прерывает разбор
+    (и скачивание) ленты, когда дальше идут только уже известные записи.
+    Качалка, получившая к этому моменту заголовки ответа, кладёт
+    в атрибут validators экземпляр http_validators - чтобы условный GET
+    работал и для таких лент."""
+
+    def __init__(self):
+        super().__init__()
+
+        self.validators = None
+
+
+def parse_server_response(s):
+    """Разбирает вывод "wget -S" (строку s), возвращает кортеж
+    из двух элементов - кода ответа HTTP (или None) и экземпляра
+    http_validators.
+    В случае редиректов wget выдаёт несколько ответов, учитывается последний."""
+
+    status = None
+    etag = u''
+    lastmodified = u''
+
+    for ln in s.splitlines():
+        ln = ln.strip()
+
+        if ln.startswith(u'HTTP/'):
+            # начало очередного ответа - всё, что было до него, нас не интересует
+            status = None
+            etag = u''
+            lastmodified = u''
+
+            ls = ln.split(None, 2)
+            if len(ls) > 1 and ls[1].isdigit():
+                status = int(ls[1])
+        elif u':' in ln:
+            hname, hval = ln.split(u':', 1)
+            hname = hname.strip().lower()
+
+            if hname == u'etag':
+                etag = hval.strip()
+            elif hname == u'last-modified':
+                lastmodified = hval.strip()
+
+    return (status, http_validators(etag, lastmodified))
+
+
+# коды ошибок wget; встроенная качалка (HTTPDownloader) выдаёт те же коды,
+# чтобы сообщения об ошибках были одинаковыми
+WGET_ERROR_GENERIC = 1
+WGET_ERROR_FILE_IO = 3
+WGET_ERROR_NETWORK = 4
+WGET_ERROR_SSL = 5
+WGET_ERROR_PROTOCOL = 7
+WGET_ERROR_SERVER = 8
+
+WGET_ERRORS = {WGET_ERROR_GENERIC:u'error',
+    2:u'parameter parse error',
+    WGET_ERROR_FILE_IO:u'file I/O error',
+    WGET_ERROR_NETWORK:u'network failure',
+    WGET_ERROR_SSL:u'SSL verification failure',
+    6:u'username/password authentication failure',
+    WGET_ERROR_PROTOCOL:u'protocol error',
+    WGET_ERROR_SERVER:u'server issued an error response'}
+
+HTTP_NOT_MODIFIED = 304
+
+# размер порции данных, читаемых качалками за раз
+DOWNLOAD_CHUNK_SIZE = 65536
+
+
+def download_error_message(prefix, code, details=None):
+    """Формирует строку с сообщением об ошибке загрузки в стиле wget."""
+
+    es = u'%s error %d' % (prefix, code)
+
+    if code in WGET_ERRORS:
+        es += u': %s' % WGET_ERRORS[code]
+
+    if details:
+        es += u' (%s)' % details
+
+    return es
+
+
+def download_url(url, timeout, fstdout, validators=None):
     """Загрузка данных с указанного адреса.
 
-    url     - адрес
-    timeout - таймаут в секундах, по превышении которого закачка должна прерываться
-    fstdout - файловый объект для скачиваемых данных
-    fstderr - файловый объект для прочего вывода внешнего процесса
+    url         - адрес
+    timeout     - таймаут в секундах, по превышении которого закачка должна прерываться
+    fstdout     - файловый объект для скачиваемых данных (достаточно
+                  наличия метода write()); данные пишутся порциями
+                  по мере скачивания
+    validators  - None или экземпляр http_validators с сохранёнными
+                  в прошлый раз значениями ETag/Last-Modified;
+                  если указан - запрос делается условным
     Для загрузки вызывается внешний процесс, выдающий данные в stdout.
 
-    В случае успеха возвращает None, в случае ошибки -
-    строку с сообщением об ошибке."""
+    Возвращает экземпляр download_result.
+    Исключения, возникшие при записи в fstdout, не перехватываются
+    (внешний процесс при этом прибивается)."""
+
+    # заголовки ответа сервера wget (с ключом -S) выдаёт в stderr
+    args = [u'wget', u'-q', u'-S', u'--timeout', u'%d' % timeout, u'--tries', u'1']
 
-    # если когда-нито будет возможность настройки на качалку, отличную от wget
-    # это нужно будет вынести в конфиг
-    WGET_ERRORS = {1:u'error',
-        2:u'parameter parse error',
-        3:u'file I/O error',
-        4:u'network failure',
-        5:u'SSL verification failure',
-        6:u'username/password authentication failure',
-        7:u'protocol error',
-        8:u'server issued an error response'}
+    if validators is not None:
+        if validators.etag:
+            args.append(u'--header=If-None-Match: %s' % validators.etag)
+        if validators.lastmodified:
+            args.append(u'--header=If-Modified-Since: %s' % validators.lastmodified)
+
+    args += [u'-O', u'-', url]
 
     # пока приколочу wget гвоздями. потом, возможно, сделаю настройку (для curl или еще чего)
-    try:
-        r = subprocess.call([u'wget', u'-q', u'--timeout', u'%d' % timeout, u'--tries', u'1', u'-O', u'-', url], stdout=fstdout, stderr=fstderr)
-        if r:
-            es = u'wget error %d' % r
 
-            if r in WGET_ERRORS:
-                es += u': %s' % WGET_ERRORS[r]
+    # заголовков в stderr немного, а вот stdout читаем по мере поступления данных
+    with TemporaryFile() as ferr:
+        try:
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=ferr)
+        except Exception as ex:
+            return download_result(u'subprocess.call() error %s' % str(ex), False, None)
+
+        stopped = None
+
+        try:
+            while True:
+                chunk = proc.stdout.read1(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                fstdout.write(chunk)
+        except FeedParsingStopped as ex:
+            # заголовки ответа wget выдаёт до данных - они уже в ferr
+            proc.kill()
+            stopped = ex
+        except:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+
+        ferr.seek(0)
+        status, newvalidators = parse_server_response(ferr.read().decode('iso-8859-1'))
+
+    if stopped is not None:
+        stopped.validators = newvalidators
+        raise stopped
+
+    if status == HTTP_NOT_MODIFIED:
+        # wget считает 304 ошибкой (код 8), а для нас это "новостей нет"
+        return download_result(None, True, validators)
+
+    if returncode:
+        return download_result(download_error_message(u'wget', returncode), False, None)
+
+    return download_result(None, False, newvalidators)
+
+
+class WgetDownloader():
+    """Загрузка лент внешним процессом (wget)."""
+
+    def download(self, url, timeout, fout, validators=None):
+        """См. download_url()."""
+
+        return download_url(url, timeout, fout, validators)
+
+    def close(self):
+        pass
+
+
+class PooledHTTPSConnection(HTTPSConnection):
+    """HTTPSConnection, повторно использующая сессию TLS
+    (чтобы при новом соединении с тем же хостом не делать полное рукопожатие)."""
+
+    def __init__(self, host, port, timeout, context, session):
+        HTTPSConnection.__init__(self, host, port, timeout=timeout, context=context)
+        self.sslSession = session
+
+    def connect(self):
+        HTTPConnection.connect(self)
+
+        self.sock = self._context.wrap_socket(self.sock,
+            server_hostname=self.host,
+            session=self.sslSession)
+
+
+class HTTPDownloaderBase():
+    """Общая часть встроенных качалок (HTTPDownloader и AsyncHTTPDownloader)."""
+
+    USER_AGENT = u'Mozilla/5.0 (compatible; RSSMailer)'
+
+    MAX_REDIRECTS = 20
+    MAX_IDLE_PER_HOST = 4
+
+    REDIRECT_CODES = set((301, 302, 303, 307, 308))
+
+    def __init__(self):
+        # ключи - кортежи (scheme, host, port), значения - списки свободных соединений
+        self.idle = {}
+
+        self.sslContext = ssl.create_default_context()
 
-            return es
-    except Exception as ex:
-        return u'subprocess.call() error %s' % str(ex)
+    def error_result(self, code, details=None):
+        return download_result(download_error_message(u'http', code, details), False, None)
 
-    return None
+    def request_headers(self, validators):
+        """Возвращает словарь с заголовками запроса."""
+
+        headers = {u'User-Agent':self.USER_AGENT,
+            u'Accept-Encoding':u'gzip'}
+
+        if validators is not None:
+            if validators.etag:
+                headers[u'If-None-Match'] = validators.etag
+            if validators.lastmodified:
+                headers[u'If-Modified-Since'] = validators.lastmodified
+
+        return headers
+
+    def split_url(self, url):
+        """Разбирает url, возвращает кортеж из двух элементов -
+        ключа для пула соединений (scheme, host, port) и пути
+        (с параметрами запроса).
+        В случае неподдерживаемого протокола возвращает (None, None)."""
+
+        p = urlsplit(url)
+        scheme = p.scheme.lower()
+
+        if scheme not in (u'http', u'https'):
+            return (None, None)
+
+        try:
+            port = p.port
+        except ValueError:
+            port = None
+
+        if not port:
+            port = 443 if scheme == u'https' else 80
+
+        path = p.path if p.path else u'/'
+        if p.query:
+            path += u'?' + p.query
+
+        return ((scheme, p.hostname, port), path)
+
+
+class HTTPDownloader(HTTPDownloaderBase):
+    """Встроенная качалка - загрузка лент без запуска внешних процессов.
+    Соединения не закрываются после запроса, а складываются в пул
+    (по отдельной очереди на каждый хост) и используются повторно
+    (HTTP keep-alive), для HTTPS используется общий SSLContext
+    и повторно используются сессии TLS.
+    Экземпляр класса может использоваться одновременно несколькими потоками."""
+
+    def __init__(self):
+        HTTPDownloaderBase.__init__(self)
+
+        self.lock = threading.Lock()
+
+        # ключи - кортежи (host, port), значения - экземпляры ssl.SSLSession
+        self.sslSessions = {}
+
+    def get_connection(self, key, timeout):
+        """Возвращает кортеж из двух элементов - соединения для key
+        и булевского значения (True, если соединение взято из пула)."""
+
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                conn = conns.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+
+                return (conn, True)
+
+            session = self.sslSessions.get(key[1:])
+
+        scheme, host, port = key
+        if scheme == u'https':
+            conn = PooledHTTPSConnection(host, port, timeout, self.sslContext, session)
+        else:
+            conn = HTTPConnection(host, port, timeout=timeout)
+
+        return (conn, False)
+
+    def put_connection(self, key, conn):
+        """Возвращает соединение в пул."""
+
+        if isinstance(conn.sock, ssl.SSLSocket) and conn.sock.session is not None:
+            with self.lock:
+                self.sslSessions[key[1:]] = conn.sock.session
+
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.MAX_IDLE_PER_HOST:
+                conns.append(conn)
+                return
+
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+
+            self.idle.clear()
+
+    def request(self, key, path, timeout, headers):
+        """Отправляет запрос GET, возвращает кортеж из двух элементов -
+        соединения и ответа (http.client.HTTPResponse).
+        Если соединение из пула оказалось закрытым сервером - запрос
+        повторяется через новое соединение."""
+
+        while True:
+            conn, reused = self.get_connection(key, timeout)
+            try:
+                conn.request(u'GET', path, headers=headers)
+                return (conn, conn.getresponse())
+            except (ConnectionError, HTTPException) as ex:
+                conn.close()
+                if not reused:
+                    raise
+            except:
+                conn.close()
+                raise
+
+    def download(self, url, timeout, fout, validators=None):
+        """Загрузка данных с указанного адреса.
+        Параметры и возвращаемое значение - как у download_url().
+        Исключения, возникшие при записи в fout, не перехватываются."""
+
+        __error = self.error_result
+
+        headers = self.request_headers(validators)
+
+        for nredirects in range(self.MAX_REDIRECTS + 1):
+            key, path = self.split_url(url)
+            if key is None:
+                return __error(WGET_ERROR_GENERIC, u'unsupported URL "%s"' % url)
+
+            try:
+                conn, resp = self.request(key, path, timeout, headers)
+            except ssl.SSLCertVerificationError as ex:
+                return __error(WGET_ERROR_SSL, str(ex))
+            except HTTPException as ex:
+                return __error(WGET_ERROR_PROTOCOL, str(ex))
+            except OSError as ex:
+                return __error(WGET_ERROR_NETWORK, str(ex))
+
+            keepconn = False
+            try:
+                if resp.status in self.REDIRECT_CODES:
+                    location = resp.getheader(u'Location')
+                    resp.read()
+                    keepconn = True
+
+                    if not location:
+                        return __error(WGET_ERROR_PROTOCOL, u'redirect without location')
+
+                    url = urljoin(url, location)
+                    continue
+
+                if resp.status == HTTP_NOT_MODIFIED:
+                    resp.read()
+                    keepconn = True
+                    return download_result(None, True, validators)
+
+                if resp.status >= 400:
+                    resp.read()
+                    keepconn = True
+                    return __error(WGET_ERROR_SERVER, u'%d %s' % (resp.status, resp.reason))
+
+                newvalidators = http_validators(resp.getheader(u'ETag', u''),
+                    resp.getheader(u'Last-Modified', u''))
+
+                if resp.getheader(u'Content-Encoding', u'').lower() == u'gzip':
+                    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                else:
+                    decomp = None
+
+                try:
+                    while True:
+                        try:
+                            chunk = resp.read1(DOWNLOAD_CHUNK_SIZE)
+                        except HTTPException as ex:
+                            return __error(WGET_ERROR_PROTOCOL, str(ex))
+                        except OSError as ex:
+                            return __error(WGET_ERROR_NETWORK, str(ex))
+
+                        if not chunk:
+                            break
+
+                        if decomp is not None:
+                            try:
+                                chunk = decomp.decompress(chunk)
+                            except zlib.error as ex:
+                                return __error(WGET_ERROR_PROTOCOL, str(ex))
+
+                        fout.write(chunk)
+
+                    if decomp is not None:
+                        fout.write(decomp.flush())
+
+                except FeedParsingStopped as ex:
+                    ex.validators = newvalidators
+                    raise
+
+                keepconn = True
+                return download_result(None, False, newvalidators)
+
+            finally:
+                if keepconn and not resp.will_close:
+                    self.put_connection(key, conn)
+                else:
+                    conn.close()
+
+        return __error(WGET_ERROR_PROTOCOL, u'too many redirects')
+
+
+class AsyncHTTPDownloader(HTTPDownloaderBase):
+    """Встроенная качалка для движка asyncio (см. load_feeds_async()).
+    Сама реализует минимально необходимое подмножество HTTP/1.1
+    (Content-Length, chunked, gzip, редиректы, keep-alive).
+    Экземпляр класса используется только из одного потока (цикла событий)."""
+
+    MAX_HEADER_LINES = 128
+
+    async def open_connection(self, key, timeout):
+        """Возвращает кортеж из трёх элементов - asyncio.StreamReader,
+        asyncio.StreamWriter и булевского значения (True, если соединение
+        взято из пула)."""
+
+        conns = self.idle.get(key)
+        while conns:
+            reader, writer = conns.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return (reader, writer, True)
+
+            writer.close()
+
+        scheme, host, port = key
+        if scheme == u'https':
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port,
+                ssl=self.sslContext, server_hostname=host), timeout)
+        else:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+
+        return (reader, writer, False)
+
+    def put_connection(self, key, reader, writer):
+        conns = self.idle.setdefault(key, [])
+        if len(conns) < self.MAX_IDLE_PER_HOST:
+            conns.append((reader, writer))
+        else:
+            writer.close()
+
+    def close(self):
+        for conns in self.idle.values():
+            for reader, writer in conns:
+                writer.close()
+
+        self.idle.clear()
+
+    async def read_line(self, reader, timeout):
+        ln = await asyncio.wait_for(reader.readline(), timeout)
+        if not ln.endswith(b'\n'):
+            raise HTTPException(u'connection closed by server')
+
+        return ln.rstrip(b'\r\n').decode('iso-8859-1')
+
+    async def read_response_head(self, reader, timeout):
+        """Читает строку статуса и заголовки ответа.
+        Возвращает кортеж (status, reason, headers), где headers -
+        словарь с заголовками (имена в нижнем регистре)."""
+
+        ls = (await self.read_line(reader, timeout)).split(None, 2)
+        if len(ls) < 2 or not ls[0].startswith(u'HTTP/') or not ls[1].isdigit():
+            raise HTTPException(u'bad status line')
+
+        status = int(ls[1])
+        reason = ls[2] if len(ls) > 2 else u''
+
+        headers = {}
+        for nlines in range(self.MAX_HEADER_LINES):
+            ln = await self.read_line(reader, timeout)
+            if not ln:
+                return (status, reason, headers)
+
+            if u':' in ln:
+                hname, hval = ln.split(u':', 1)
+                headers[hname.strip().lower()] = hval.strip()
+
+        raise HTTPException(u'too many headers')
+
+    async def request(self, key, path, timeout, headers):
+        """Отправляет запрос GET, возвращает кортеж из пяти элементов -
+        reader, writer, status, reason, headers.
+        Если соединение из пула оказалось закрытым сервером - запрос
+        повторяется через новое соединение."""
+
+        scheme, host, port = key
+        hosthdr = host if port == (443 if scheme == u'https' else 80) else u'%s:%d' % (host, port)
+
+        rq = [u'GET %s HTTP/1.1' % path, u'Host: %s' % hosthdr]
+        rq += [u'%s: %s' % hdr for hdr in headers.items()]
+        rq = (u'\r\n'.join(rq) + u'\r\n\r\n').encode('ascii')
+
+        while True:
+            reader, writer, reused = await self.open_connection(key, timeout)
+            try:
+                writer.write(rq)
+                await asyncio.wait_for(writer.drain(), timeout)
+
+                return (reader, writer) + (await self.read_response_head(reader, timeout))
+            except (ConnectionError, HTTPException) as ex:
+                writer.close()
+                if not reused:
+                    raise
+            except:
+                writer.close()
+                raise
+
+    async def read_body(self, reader, status, headers, timeout, fout):
+        """Читает тело ответа, пишет его в fout (если fout не None).
+        Возвращает True, если по окончании чтения соединение
+        можно использовать повторно."""
+
+        if status == HTTP_NOT_MODIFIED or status == 204 or status < 200:
+            return True
+
+        if headers.get(u'content-encoding', u'').lower() == u'gzip' and fout is not None:
+            decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decomp = None
+
+        def __write(chunk):
+            if fout is not None:
+                fout.write(decomp.decompress(chunk) if decomp is not None else chunk)
+
+        if headers.get(u'transfer-encoding', u'').lower() == u'chunked':
+            while True:
+                csize = (await self.read_line(reader, timeout)).split(u';', 1)[0].strip()
+                try:
+                    csize = int(csize, 16)
+                except ValueError:
+                    raise HTTPException(u'bad chunk size')
+
+                if csize == 0:
+                    # трейлеры
+                    while await self.read_line(reader, timeout):
+                        pass
+                    break
+
+                __write(await asyncio.wait_for(reader.readexactly(csize), timeout))
+                await asyncio.wait_for(reader.readexactly(2), timeout)
+
+            reusable = True
+        elif u'content-length' in headers:
+            try:
+                remain = int(headers[u'content-length'])
+            except ValueError:
+                raise HTTPException(u'bad content length')
+
+            while remain > 0:
+                chunk = await asyncio.wait_for(reader.read(min(remain, DOWNLOAD_CHUNK_SIZE)), timeout)
+                if not chunk:
+                    raise HTTPException(u'connection closed by server')
+
+                remain -= len(chunk)
+                __write(chunk)
+
+            reusable = True
+        else:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(DOWNLOAD_CHUNK_SIZE), timeout)
+                if not chunk:
+                    break
+
+                __write(chunk)
+
+            reusable = False
+
+        if decomp is not None:
+            fout.write(decomp.flush())
+
+        return reusable and headers.get(u'connection', u'').lower() != u'close'
+
+    async def download(self, url, timeout, fout, validators=None):
+        """Загрузка данных с указанного адреса.
+        Параметры и возвращаемое значение - как у download_url().
+        Исключения, возникшие при записи в fout, не перехватываются."""
+
+        __error = self.error_result
+
+        headers = self.request_headers(validators)
+        headers[u'Connection'] = u'keep-alive'
+
+        for nredirects in range(self.MAX_REDIRECTS + 1):
+            key, path = self.split_url(url)
+            if key is None:
+                return __error(WGET_ERROR_GENERIC, u'unsupported URL "%s"' % url)
+
+            writer = None
+            keepconn = False
+            try:
+                reader, writer, status, reason, rheaders = await self.request(key, path, timeout, headers)
 
+                if status in self.REDIRECT_CODES or status == HTTP_NOT_MODIFIED or status >= 400:
+                    keepconn = await self.read_body(reader, status, rheaders, timeout, None)
+
+                    if status == HTTP_NOT_MODIFIED:
+                        return download_result(None, True, validators)
+
+                    if status >= 400:
+                        return __error(WGET_ERROR_SERVER, u'%d %s' % (status, reason))
+
+                    location = rheaders.get(u'location')
+                    if not location:
+                        return __error(WGET_ERROR_PROTOCOL, u'redirect without location')
+
+                    url = urljoin(url, location)
+                    continue
+
+                newvalidators = http_validators(rheaders.get(u'etag', u''),
+                    rheaders.get(u'last-modified', u''))
+
+                try:
+                    keepconn = await self.read_body(reader, status, rheaders, timeout, fout)
+                except FeedParsingStopped as ex:
+                    ex.validators = newvalidators
+                    raise
+
+                return download_result(None, False, newvalidators)
+
+            except ssl.SSLCertVerificationError as ex:
+                return __error(WGET_ERROR_SSL, str(ex))
+            except (HTTPException, UnicodeError, zlib.error) as ex:
+                return __error(WGET_ERROR_PROTOCOL, str(ex))
+            except asyncio.TimeoutError:
+                return __error(WGET_ERROR_NETWORK, u'timed out')
+            except (OSError, EOFError) as ex:
+                return __error(WGET_ERROR_NETWORK, str(ex))
+
+            finally:
+                if writer is not None:
+                    if keepconn:
+                        self.put_connection(key, reader, writer)
+                    else:
+                        writer.close()
+
+        return __error(WGET_ERROR_PROTOCOL, u'too many redirects')
+
+
+def make_downloader(env):
+    """Создаёт качалку в соответствии с настройками env."""
+
+    if env.settDownloader == DOWNLOADER_BUILTIN:
+        return HTTPDownloader()
+    else:
+        return WgetDownloader()
+
+
+
+# всё, кроме букв и цифр (см. text_hash)
+# среди символов ASCII:
+_ASCII_NOT_ALNUM = bytes(filter(lambda c: not chr(c).isalnum(), range(128)))
+# и прочих: в юникодных регулярках \w - это в точности символы,
+# для которых str.isalnum() == True, плюс "_"
+_NONASCII_NOT_ALNUM_RX = re.compile(r'[^\w\x00-\x7f]+')
+
+# кэш text_hash(): сколько описаний держать и описания какой длины
+# (в символах) кэшировать; кэш держит ссылки на сами строки, так что
+# занимает до TEXT_HASH_CACHE_SIZE * TEXT_HASH_CACHE_MAX_LEN символов
+# (сотни килобайт), а длинные описания (бывают по сотне килобайт)
+# не кэшируются - их хэш и так считается быстрее, чем они скачиваются
+TEXT_HASH_CACHE_SIZE = 256
+TEXT_HASH_CACHE_MAX_LEN = 1024
+
+
+def _text_hash(txt):
+    """См. text_hash() (без кэша).
+    Результат должен совпадать с тем, что насчитали прежние версии
+    (хэши хранятся в истории лент) - алгоритм не менять!"""
+
+    if not txt or txt.isspace():
+        return u''
+
+    # сначала выкидываем лишнее из ASCII: bytes.translate() на порядок быстрее
+    # посимвольной фильтрации, а байты < 128 в UTF-8 - всегда символы ASCII
+    s = txt.encode('utf-8', 'surrogatepass').translate(None, _ASCII_NOT_ALNUM)
+    if s.isascii():
+        return md5(s.lower()).hexdigest()
+
+    # utf-8 потому, что hashlib жреть только 8-битные строки (точнее даже, байты)
+    s = _NONASCII_NOT_ALNUM_RX.sub(u'', s.decode('utf-8', 'surrogatepass'))
+    return md5(s.lower().encode('utf-8', errors='replace')).hexdigest()
+
+
+_text_hash_cached = lru_cache(maxsize=TEXT_HASH_CACHE_SIZE)(_text_hash)
 
 
 def text_hash(txt):
     """Нормализует юникодную строку txt (удаляя всё, кроме букв и цифр,
-    и приводя к нижнему регистру), считает от нее md5 и возвращает дайджест."""
+    и приводя к нижнему регистру), считает от нее md5 и возвращает дайджест.
+    Хэши коротких (не длиннее TEXT_HASH_CACHE_MAX_LEN) описаний
+    кэшируются - кэш занимает не более нескольких сотен килобайт."""
 
-    # utf-8 потому, что hashlib жреть только 8-битные строки (точнее даже, байты)
-    txt = txt.strip()
-    return u'' if not txt else md5((u''.join(filter(lambda c: c.isalnum(), txt))).lower().encode('utf-8', errors='replace')).hexdigest()
+    if txt and len(txt) > TEXT_HASH_CACHE_MAX_LEN:
+        return _text_hash(txt)
+
+    return _text_hash_cached(txt)
+
+
+class FeedStreamParser():
+    """Файлоподобный объект для качалок: всё, что в него пишется,
+    сразу скармливается инкрементальному парсеру XML, т.е. разбор
+    ленты идёт одновременно со скачиванием, без временных файлов."""
+
+    def __init__(self, handler, onstart=None):
+        """handler  - обработчик SAX (экземпляр RSSFeed)
+        onstart     - None или функция без параметров, вызываемая
+                      перед скармливанием парсеру первой порции данных."""
+
+        self.parser = xml_make_parser()
+        self.parser.setContentHandler(handler)
+
+        self.onstart = onstart
+        self.started = False
+
+    def write(self, data):
+        if not data:
+            return
+
+        if not self.started:
+            self.started = True
+            if self.onstart is not None:
+                self.onstart()
+
+        self.parser.feed(data)
+
+    def close(self):
+        """Завершение разбора. Если данных не было вообще - парсер
+        выдаст ошибку, как и положено для пустого документа."""
+
+        if not self.started:
+            # иначе ExpatParser.close() молча ничего не сделает
+            self.parser.feed(b'')
+
+        self.parser.close()
 
 
 class RSSFeed(rssparser.RSSHandler):
     """Разбор ленты RSS, проверка на уникальность записей и т.п.
     Стараниями разных [censored], генерящих кривые ленты, приходится проверять
-    уникальность не только поля guid, но и link."""
-
-    recordids = namedtuple('recordids', 'link dhash')
-    # link - ссылка на запись из ленты
-    # dhash - хэш описания записи
+    уникальность не только поля guid, но и link (см. rssmailerhistory)."""
 
-    def __init__(self, env, url, title, timeout, longdesc, skip):
+    def __init__(self, env, url, title, timeout, longdesc, skip, stopafter=0,
+            historydays=None, historymax=None, mailto=None, group=None):
         rssparser.RSSHandler.__init__(self)
 
         self.url = url
 
-        fbasename = url_to_file_name(url)
-        self.guidListFileName = os.path.join(env.feedDir, fbasename + u'.guids')
+        # путь к файлам ленты без суффикса
+        self.fileBase = feed_file_base(env, url)
+        self.guidListFileName = self.fileBase + FEED_FILE_GUIDS
+        # кэш валидаторов HTTP (ETag/Last-Modified) для условного GET
+        self.validatorsFileName = self.fileBase + FEED_FILE_VALIDATORS
+
+        # ограничения на размер истории ленты (если None - из общих настроек)
+        self.historyDays = historydays
+        self.historyMax = historymax
+
+        # список адресов получателей писем с новостями ленты
+        # (если None - из общих настроек)
+        self.mailTo = mailto
+        # название группы лент для писем-сводок (см. env.settDigest)
+        self.group = group
 
         # данные для проверки на уникальность записи
-        # словарь - для загрузки-сохранения
-        # ключи - guid'ы, значения - экземпляры recordids
-        self.guids = {}
-        # и отдельные множества - для проверки (чтоб не лазать вручную в содержимое словаря)
-        self.links = set()
-        # т.к. разные жопорукие постят в ленты одинаковые псто с разными
-        # guid'ами и ссылками, буду проверять еще и по хэшу содержимого
-        self.hashes = set()
+        self.history = feed_history(env, url, self.guidListFileName, historydays, historymax)
 
         self.items = []
+        # разобранные, но ещё не проверенные записи (см. flush_item)
+        self.pendingItems = []
         self.newItems = 0
+        # True, если при последней загрузке сервер ответил "304 Not Modified"
+        self.notModified = False
+        # валидаторы, полученные при последней загрузке (экземпляр http_validators);
+        # сохраняются вместе с guid'ами, иначе при неудачной отправке
+        # почты следующая загрузка получила бы 304, и новости бы потерялись
+        self.validators = None
         self.title = title
         self.timeout = timeout
         self.skip = skip
         self.longdesc = longdesc
+        # если не 0 - разбор ленты прекращается после stopAfter уже известных
+        # записей подряд (ленты обычно идут от новых записей к старым, так что
+        # дальше будут только старые)
+        self.stopAfter = stopafter
+        # кол-во уже известных записей, встреченных подряд
+        self.knownInRow = 0
         self.delete = False # костыль для удалятора в осн. модуле
 
         self.dltime = 0.0
@@ -159,121 +1037,235 @@ class RSSFeed(rssparser.RSSHandler):
         # тип ошибки (в виде строки)
         self.errortype = None
 
+    # сколько разобранных записей копить перед проверкой (см. flush_item)
+    ITEM_BATCH_SIZE = 32
+
+    def __known_item(self):
+        """Учёт уже известной записи; если таких записей подряд набралось
+        self.stopAfter - прерывает разбор ленты."""
+
+        self.knownInRow += 1
+
+        if self.stopAfter and self.knownInRow >= self.stopAfter:
+            raise FeedParsingStopped()
+
     def __set_error(self, emsg, etype):
         self.error = emsg
         self.errortype = etype
 
     def load_guids(self):
-        """Файл истории событий. В нем хранятся guid и link.
-        Для совместимости с предыдущей версией при загрузке проверяется
-        кол-во полей в файле."""
-
-        self.guids.clear()
-        self.links.clear()
-        self.hashes.clear()
-
-        if os.path.isfile(self.guidListFileName):
-            with open(self.guidListFileName, 'r', encoding=IOENCODING) as f:
-                for s in f:
-                    s = s.strip()
-                    if not s:
-                        continue
-
-                    # не уверен, что guid в rss не может содержать ";", но пока плевать
-                    s = list(map(lambda t: t.strip(), s.split(u';')))
-                    ls = len(s)
-
-                    s_guid = s[0]
-
-                    # link
-                    if ls > 1 and s[1] and s[1] != s_guid:
-                        s_link = s[1].lower() # url'ы вроде бы регистронезависимы?
-                        self.links.add(s_link)
-                    else:
-                        s_link = u''
+        self.history.load()
 
-                    # description hash
-                    if ls > 2 and s[2]:
-                        s_dhash = s[2]
-                        self.hashes.add(s_dhash)
-                    else:
-                        s_dhash = u''
+    def save_guids(self):
+        self.history.save()
 
-                    # guid
-                    self.guids[s_guid] = self.recordids(s_link, s_dhash)
+        self.save_validators()
 
-    def save_guids(self):
-        with open(self.guidListFileName, 'w+', encoding=IOENCODING) as f:
-            for guid in self.guids:
-                r = self.guids[guid]
-                f.write(u'%s;%s;%s\n' % (guid, r.link, r.dhash))
+    def load_validators(self):
+        """Загружает из файла сохранённые в прошлый раз значения
+        заголовков ETag и Last-Modified.
+        Возвращает экземпляр http_validators или None, если файла нет."""
 
-    def flush_item(self, item):
-        dhash = text_hash(item.description)
+        if not os.path.isfile(self.validatorsFileName):
+            return None
 
-        # проверка на уникальность поста
-        # не хочу громоздить if ... в одну строку, так нагляднее
+        etag = u''
+        lastmodified = u''
 
-        if item.guid in self.guids:
-            return
+        with open(self.validatorsFileName, 'r', encoding=IOENCODING) as f:
+            for s in f:
+                if u':' not in s:
+                    continue
+
+                hname, hval = s.split(u':', 1)
+                hname = hname.strip().lower()
 
-        # возможно, не совсем правильно, т.к. в кривых лентах могут и линки разные при одинаковых гуидах оказаться...
-        if item.link in self.links:
+                if hname == u'etag':
+                    etag = hval.strip()
+                elif hname == u'last-modified':
+                    lastmodified = hval.strip()
+
+        return http_validators(etag, lastmodified) if etag or lastmodified else None
+
+    def save_validators(self):
+        """Сохраняет в файл валидаторы, полученные при последней загрузке."""
+
+        if self.validators is None:
             return
 
-        if dhash and dhash in self.hashes:
+        if not self.validators.etag and not self.validators.lastmodified:
+            # сервер условный GET не поддерживает - старый кэш не нужен
+            if os.path.isfile(self.validatorsFileName):
+                os.remove(self.validatorsFileName)
             return
 
-        self.items.append(item)
+        make_file_dir(self.validatorsFileName)
+
+        with open(self.validatorsFileName, 'w+', encoding=IOENCODING) as f:
+            if self.validators.etag:
+                f.write(u'ETag: %s\n' % self.validators.etag)
+            if self.validators.lastmodified:
+                f.write(u'Last-Modified: %s\n' % self.validators.lastmodified)
+
+    def flush_item(self, item):
+        """Вызывается парсером для каждой разобранной записи.
+        Записи проверяются пачками по ITEM_BATCH_SIZE (см. flush_items),
+        остаток - по окончании разбора.
+        Если указан stopAfter - пачка проверяется, как только в ней набралось
+        столько записей, сколько не хватает до stopAfter известных подряд,
+        чтобы не разбирать лишнего."""
+
+        self.pendingItems.append(item)
+
+        batchsize = self.ITEM_BATCH_SIZE
+        if self.stopAfter:
+            # self.knownInRow < self.stopAfter, иначе разбор был бы уже прерван
+            batchsize = min(batchsize, self.stopAfter - self.knownInRow)
+
+        if len(self.pendingItems) >= batchsize:
+            self.flush_pending_items()
+
+    def flush_pending_items(self):
+        items = self.pendingItems
+        self.pendingItems = []
+
+        self.flush_items(items)
+
+    def flush_items(self, items):
+        """Проверка на уникальность записей из списка items (экземпляров
+        rss_item) и добавление новых в self.items.
+        Сначала - дешёвые проверки: guid'ы всей пачки проверяются по истории
+        разом (см. FeedHistory.known_guids), затем ссылки; хэш описания
+        считается только для записей, не отсеянных по guid'у и ссылке,
+        т.е. для уже известных записей (которых обычно большинство)
+        не считается вовсе.
+        Если набралось stopAfter известных записей подряд - исключение
+        FeedParsingStopped (остаток пачки не проверяется)."""
+
+        known = self.history.known_guids([item.guid for item in items])
+        # guid'ы, добавленные из этой же пачки
+        added = set()
+
+        for item in items:
+            # проверка на уникальность поста
+            # не хочу громоздить if ... в одну строку, так нагляднее
+
+            if item.guid in known or item.guid in added:
+                self.__known_item()
+                continue
+
+            # возможно, не совсем правильно, т.к. в кривых лентах могут и линки разные при одинаковых гуидах оказаться...
+            if self.history.has_link(item.link):
+                self.__known_item()
+                continue
+
+            dhash = text_hash(item.description)
 
-        self.guids[item.guid] = self.recordids(item.link.lower() if item.link and item.link != item.guid else u'', dhash)
-        self.links.add(item.link)
+            if dhash and self.history.has_hash(dhash):
+                self.__known_item()
+                continue
 
-        if dhash:
-            self.hashes.add(dhash)
+            self.knownInRow = 0
 
-        self.newItems += 1
+            self.items.append(item)
 
-    def download(self):
-        """Засасывает ленту, отбрасывая ранее
-        загруженные элементы с помощью списка guid'ов"""
+            self.history.add(item.guid, item.link, dhash)
+            added.add(item.guid)
+
+            self.newItems += 1
+
+    def __download_started(self):
+        """Сброс состояния перед загрузкой.
+        Возвращает валидаторы для условного GET (или None)."""
 
         self.__set_error(None, None)
 
+        del self.items[:]
+        del self.pendingItems[:]
+        self.newItems = 0
+        self.knownInRow = 0
+        self.notModified = False
+        self.validators = None
+
+        return self.load_validators()
+
+    def __download_finished(self, dlr, parser, stopped=None):
+        """Обработка результата загрузки.
+        dlr         - экземпляр download_result или None, если разбор
+                      (и загрузка) прерваны досрочно
+        parser      - экземпляр FeedStreamParser, которому качалка
+                      скармливала данные
+        stopped     - None или исключение FeedParsingStopped, которым
+                      был прерван разбор.
+        Возвращает True в случае успеха."""
+
+        if stopped is not None:
+            # документ разобран не до конца, закрывать парсер нельзя - заругается;
+            # валидаторы качалка успела получить вместе с заголовками ответа
+            self.validators = stopped.validators
+        elif dlr.error:
+            self.__set_error(dlr.error, 'download')
+            return False
+
+        elif dlr.notmodified:
+            # лента не изменилась - ни разбирать, ни грузить историю незачем
+            self.notModified = True
+            return True
+        else:
+            self.validators = dlr.validators
+
+            # историю загружает сам parser перед разбором первой порции данных
+            parser.close()
+
+            try:
+                self.flush_pending_items()
+            except FeedParsingStopped:
+                pass
+
+        #self.save_guids()
+        #не будем теперь гуиды сохранять отседова. будем только после успешного отсыла почты.
+        # а вот валидаторы при отсутствии новостей сохранять можно (и нужно) сразу -
+        # терять нечего
+        if not self.newItems:
+            self.save_validators()
+
+        return True
+
+    def download(self, downloader=None):
+        """Засасывает ленту, отбрасывая ранее
+        загруженные элементы с помощью списка guid'ов.
+        downloader  - экземпляр WgetDownloader или HTTPDownloader
+                      (если None - используется wget)."""
+
+        if downloader is None:
+            downloader = WgetDownloader()
+
         try:
-            self.load_guids()
-            del self.items[:]
-            self.newItems = 0
+            validators = self.__download_started()
 
             dltime0 = time()
             try:
-                # засасывать будем с помощью внешнего процесса
-                # а именно wget
+                # засасывать будем с помощью внешнего процесса (wget)
+                # или встроенной качалкой - см. make_downloader()
 
-                # заставляем wget молча срать в stdout, который перенаправлен во временный файл
-                with NamedTemporaryFile() as tempf:
-                    with open(os.devnull, 'w') as nulldev:
-                        #print('downloading from', self.url)
-                        es = download_url(self.url, self.timeout, tempf, nulldev)
-                        #print('end download:', es)
-                        if es:
-                            self.__set_error(es, 'download')
-                            return False
+                # качалка скармливает данные парсеру по мере скачивания;
+                # историю грузим только если данные таки пришли (т.е. не 304)
+                parser = FeedStreamParser(self, self.load_guids)
 
-                    tempf.flush()
-                    tempf.seek(0)
+                #print('downloading from', self.url)
+                try:
+                    dlr = downloader.download(self.url, self.timeout, parser, validators)
+                except FeedParsingStopped as ex:
+                    return self.__download_finished(None, parser, ex)
+                #print('end download:', dlr)
 
-                    # скармливаем имя, а не объект - иначе на питоне 3.4 парсер может глупо икнуть
-                    xml_parse(tempf.name, self)
+                return self.__download_finished(dlr, parser)
 
             finally:
                 self.dltime = time() - dltime0
 
-            #self.save_guids()
-            #не будем теперь гуиды сохранять отседова. будем только после успешного отсыла почты.
-
-            self.error = None
-            return True
+                # проверки по истории больше не понадобятся
+                self.history.release()
 
         #except (SAXParseException, OSError), msg:
         except Exception as ex:
@@ -282,90 +1274,274 @@ class RSSFeed(rssparser.RSSHandler):
             #print(self.error)
             return False
 
+    async def download_async(self, downloader):
+        """То же, что download(), но для движка asyncio.
+        downloader  - экземпляр AsyncHTTPDownloader."""
+
+        try:
+            validators = self.__download_started()
+
+            dltime0 = time()
+            try:
+                parser = FeedStreamParser(self, self.load_guids)
+
+                try:
+                    dlr = await downloader.download(self.url, self.timeout, parser, validators)
+                except FeedParsingStopped as ex:
+                    return self.__download_finished(None, parser, ex)
+
+                return self.__download_finished(dlr, parser)
+
+            finally:
+                self.dltime = time() - dltime0
+
+                # проверки по истории больше не понадобятся
+                self.history.release()
+
+        except Exception as ex:
+            self.__set_error(str(ex), 'parse')
+            return False
+
 
 class RSSLoaderThread(threading.Thread):
-    def __init__(self, feed):
+    """Поток-загрузчик. Берёт из очереди feedqueue кортежи (номер, лента),
+    пока очередь не опустеет; по окончании загрузки каждой ленты кладёт
+    в очередь resultqueue кортеж (номер, сообщение об ошибке или None)."""
+
+    def __init__(self, feedqueue, resultqueue, downloader):
         threading.Thread.__init__(self)
-        self.feed = feed
-        self.error = None
+        self.feedqueue = feedqueue
+        self.resultqueue = resultqueue
+        self.downloader = downloader
 
     def run(self):
         # здесь - никаких логов, ибо в сочетании с многопоточностью получается хня
-        try:
-            #print('begin ', self.feed.url)
-            self.feed.download()
-            #print('end', self.feed.url)
-        except Exception as ex:
-            self.error = str(ex)
+        while True:
+            try:
+                fix, feed = self.feedqueue.get_nowait()
+            except queue.Empty:
+                return
 
+            error = None
+            try:
+                #print('begin ', feed.url)
+                feed.download(self.downloader)
+                #print('end', feed.url)
+            except Exception as ex:
+                error = str(ex)
 
-def load_feeds(env, feeds):
-    """Грузит все ленты (экземпляров RSSFeed) из списка feeds пачками по maxdownloads.
-    Возвращает список лент, у которых поле skip == False (т.е. в т.ч.
-    лент с ошибками загрузки!)."""
+            self.resultqueue.put((fix, error))
 
-    feeds = list(filter(lambda f: not f.skip, feeds))
 
-    if not feeds:
-        return []
+def log_feed_result(env, feed, feedn):
+    """Какает в лог результатом загрузки ленты feed.
+    feedn - строка с номером и названием ленты."""
+
+    if feed.error:
+        env.logger.error(u'%s error %s - %s' % (feed.errortype, feedn, feed.error))
+    elif feed.notModified:
+        env.logger.debug(u'%s checked by %d sec., not modified' % (feedn, feed.dltime))
+    else:
+        env.logger.debug(u'%s downloaded by %d sec., %s new(s)' % (feedn, feed.dltime, (u'%d' % feed.newItems) if feed.newItems else u'no'))
+
+
+class FeedResultLogger():
+    """Вывод в лог результатов загрузки лент.
+    Загрузки завершаются в произвольном порядке, а в лог результаты
+    выводятся в порядке следования лент в списке - по мере того, как
+    завершаются загрузки всех предыдущих лент."""
+
+    def __init__(self, env, feeds):
+        self.env = env
+        self.feeds = feeds
+
+        nfeeds = len(feeds)
+        self.fnumfmt = u'%%.%1dd/%d' % (len(str(nfeeds)), nfeeds)
+
+        self.done = [False] * nfeeds
+        # номер первой ленты, результат загрузки которой ещё не выведен
+        self.nextix = 0
+
+    def feed_done(self, fix):
+        """Отмечает ленту с номером fix (считая с нуля) как загруженную."""
+
+        self.done[fix] = True
+
+        while self.nextix < len(self.feeds) and self.done[self.nextix]:
+            feed = self.feeds[self.nextix]
+            self.nextix += 1
+
+            log_feed_result(self.env, feed, u'feed %s "%s"' % (self.fnumfmt % self.nextix, feed.title))
+
+
+# вес последнего замера при усреднении времени загрузки ленты
+FEED_TIME_WEIGHT = 0.5
+
+
+def load_feed_times(env):
+    """Загружает из файла env.feedTimesFileName ожидаемое (усреднённое
+    по прошлым запускам) время загрузки лент.
+    Возвращает словарь, где ключи - URL лент, значения - время в секундах."""
+
+    times = {}
+
+    if os.path.isfile(env.feedTimesFileName):
+        with open(env.feedTimesFileName, 'r', encoding=IOENCODING) as f:
+            for s in f:
+                s = s.strip()
+                if not s or u';' not in s:
+                    continue
+
+                st, url = s.split(u';', 1)
+                try:
+                    times[url] = float(st)
+                except ValueError:
+                    continue
+
+    return times
+
+
+def save_feed_times(env, feeds, times):
+    """Обновляет ожидаемое время загрузки для лент из списка feeds
+    (экземпляров RSSFeed) последними замерами, сохраняет словарь times
+    (см. load_feed_times()) в файл.
+    Записи для лент, которых уже нет в списке, выкидываются."""
+
+    for feed in feeds:
+        t = times.get(feed.url)
+        times[feed.url] = feed.dltime if t is None else t + (feed.dltime - t) * FEED_TIME_WEIGHT
+
+    with open(env.feedTimesFileName, 'w+', encoding=IOENCODING) as f:
+        for url in sorted(times):
+            f.write(u'%.3f;%s\n' % (times[url], url))
+
+
+def feed_download_order(feeds, times):
+    """Возвращает список номеров лент из feeds в порядке загрузки:
+    сначала самые медленные (по прошлым замерам из times), чтобы они
+    качались одновременно с кучей быстрых, а не оказывались в хвосте.
+    Ленты, для которых замеров нет, идут первыми."""
+
+    def __expected_time(fix):
+        t = times.get(feeds[fix].url)
+        return float('inf') if t is None else t
+
+    return sorted(range(len(feeds)), key=__expected_time, reverse=True)
+
+
+def load_feeds_threaded(env, feeds, order, reslog, ondone):
+    """Грузит ленты из списка feeds в порядке, указанном списком номеров
+    order; одновременно работают до env.settDownloads потоков.
+    Очередной поток берёт следующую ленту, как только закончит с
+    предыдущей, т.е. одна медленная лента не задерживает остальные.
+    ondone - см. load_feeds()."""
 
     nfeeds = len(feeds)
-    env.logger.info(u'downloading %d feed(s)' % nfeeds)
 
-    fnumfmt = u'%%.%1dd/%d' % (len(str(nfeeds)), nfeeds)
+    feedqueue = queue.Queue()
+    for fix in order:
+        feedqueue.put((fix, feeds[fix]))
 
-    dltime = time()
+    resultqueue = queue.Queue()
+
+    downloader = make_downloader(env)
     try:
-        fix = 0
-        while nfeeds:
-            ndlds = nfeeds if nfeeds < env.settDownloads else env.settDownloads
-            #print ndlds
+        loaders = []
+        for i in range(min(env.settDownloads, nfeeds)):
+            t = RSSLoaderThread(feedqueue, resultqueue, downloader)
+            loaders.append(t)
+            t.start()
 
-            # стартуем ndlds загрузок
-            #print 'loading %d feeds' % ndlds
+        for i in range(nfeeds):
+            fix, error = resultqueue.get()
 
-            loaders = []
-            fbundle = feeds[fix:fix+ndlds]
+            if error:
+                env.logger.error('downloader thread error (%s), feed "%s"' % (error, feeds[fix].url))
 
-            #print('bundle of %d downloads' % ndlds)
+            reslog.feed_done(fix)
 
-            for feed in fbundle:
-                t = RSSLoaderThread(feed)
-                loaders.append(t)
-                t.start()
+            if ondone is not None:
+                ondone(feeds[fix])
 
-            # ждем, пока все не отработают.
-            # тут можно получить бесконечный цикл, надо че-то придумать
-            for thrd in loaders:
-                if t.is_alive():
-                    t.join()
-                else:
-                    sleep(0.1)
-            #while filter(lambda t: t.is_alive(), loaders):
-            #    sleep(0.1)
+        for t in loaders:
+            t.join()
+
+    finally:
+        downloader.close()
 
-            for ldr in loaders:
-                if ldr.error:
-                    env.logger.error('downloader thread error (%s), feed "%s"' % (ldr.error, ldr.feed.url))
 
-            # какаем в лог результатами текущей порции закачек
-            for fsubix, feed in enumerate(fbundle):
-                fsubix += 1
-                feedn = u'feed %s "%s"' % (fnumfmt % (fix + fsubix), feed.title)
+def load_feeds_async(env, feeds, order, reslog, ondone):
+    """Грузит ленты из списка feeds в порядке, указанном списком номеров
+    order, с помощью asyncio - в одном потоке, одновременно до
+    env.settDownloads загрузок.
+    ondone - см. load_feeds(); вызывается в отдельном потоке, чтобы
+    его ожидание не останавливало остальные загрузки."""
 
-                if feed.error:
-                    env.logger.error(u'%s error %s - %s' % (feed.errortype, feedn, feed.error))
-                else:
-                    env.logger.debug(u'%s downloaded by %d sec., %s new(s)' % (feedn, feed.dltime, (u'%d' % feed.newItems) if feed.newItems else u'no'))
+    async def __load_all():
+        downloader = AsyncHTTPDownloader()
+
+        # общий итератор на все сопрограммы-загрузчики: как только
+        # какая-то из них освободилась, она берёт следующую ленту
+        fiter = iter(order)
+
+        async def __loader():
+            for fix in fiter:
+                await feeds[fix].download_async(downloader)
+                reslog.feed_done(fix)
+
+                if ondone is not None:
+                    await asyncio.to_thread(ondone, feeds[fix])
+
+        try:
+            await asyncio.gather(*[__loader() for i in range(min(env.settDownloads, len(feeds)))])
+        finally:
+            downloader.close()
+
+    asyncio.run(__load_all())
+
+
+def load_feeds(env, feeds, ondone=None):
+    """Грузит все ленты (экземпляров RSSFeed) из списка feeds, одновременно
+    не более env.settDownloads загрузок.
+    ondone  - если не None - функция, которой по завершении загрузки
+              каждой ленты (в порядке завершения) передаётся эта лента
+              (в т.ч. с ошибкой загрузки); может вызываться из разных
+              потоков и задерживать следующие загрузки.
+    Возвращает список лент, у которых поле skip == False (т.е. в т.ч.
+    лент с ошибками загрузки!)."""
 
-            nfeeds -= ndlds
-            fix += ndlds
+    allurls = set(map(lambda f: f.url, feeds))
+
+    feeds = list(filter(lambda f: not f.skip, feeds))
+
+    if not feeds:
+        return []
+
+    nfeeds = len(feeds)
+    env.logger.info(u'downloading %d feed(s)' % nfeeds)
+
+    reslog = FeedResultLogger(env, feeds)
+
+    times = load_feed_times(env)
+    order = feed_download_order(feeds, times)
+
+    dltime = time()
+    try:
+        if env.settEngine == ENGINE_ASYNCIO:
+            load_feeds_async(env, feeds, order, reslog, ondone)
+        else:
+            load_feeds_threaded(env, feeds, order, reslog, ondone)
 
     finally:
         dltime = time() - dltime
 
         env.logger.info(u'total download time is %d sec.' % dltime)
 
+    for url in set(times) - allurls:
+        del times[url]
+
+    save_feed_times(env, feeds, times)
+
     nHasNews = 0
     for f in feeds:
         if f.error is None and f.newItems:
@@ -382,6 +1558,11 @@ class RSSFeedSources(list):
     CV_URL = 'url'
     CV_TIMEOUT = 'timeout'
     CV_LONGDESC = 'longdesc'
+    CV_STOPAFTER = 'stop-after'
+    CV_HISTORYDAYS = 'history-days'
+    CV_HISTORYMAX = 'history-max'
+    CV_TO = 'to'
+    CV_GROUP = 'group'
 
     def load(self, env):
         """Разбирает файл с именем feedListFileName, возвращает
@@ -412,7 +1593,18 @@ class RSSFeedSources(list):
 
             flongdesc = cfg.get_bool(ftitle, self.CV_LONGDESC)
 
-            feed = RSSFeed(env, furl, ftitle, ftimeout, flongdesc, fskip)
+            fstopafter = cfg.get_int(ftitle, self.CV_STOPAFTER, 0, 0)
+
+            fhistorydays = cfg.get_int(ftitle, self.CV_HISTORYDAYS, None, 0)
+            fhistorymax = cfg.get_int(ftitle, self.CV_HISTORYMAX, None, 0)
+
+            fmailto = list(filter(None, map(lambda t: t.strip(), cfg.get_str(ftitle, self.CV_TO).split(u','))))
+
+            fgroup = cfg.get_str(ftitle, self.CV_GROUP)
+
+            feed = RSSFeed(env, furl, ftitle, ftimeout, flongdesc, fskip, fstopafter,
+                fhistorydays, fhistorymax, fmailto if fmailto else None,
+                fgroup if fgroup else None)
             self.append(feed)
 
     def save(self, env):
@@ -431,6 +1623,21 @@ class RSSFeedSources(list):
             if feed.timeout != DOWNLOAD_TIMEOUT:
                 cfg.set(feed.title, self.CV_TIMEOUT, str(feed.timeout))
 
+            if feed.stopAfter:
+                cfg.set(feed.title, self.CV_STOPAFTER, str(feed.stopAfter))
+
+            if feed.historyDays is not None:
+                cfg.set(feed.title, self.CV_HISTORYDAYS, str(feed.historyDays))
+
+            if feed.historyMax is not None:
+                cfg.set(feed.title, self.CV_HISTORYMAX, str(feed.historyMax))
+
+            if feed.mailTo:
+                cfg.set(feed.title, self.CV_TO, u', '.join(feed.mailTo))
+
+            if feed.group:
+                cfg.set(feed.title, self.CV_GROUP, feed.group)
+
         cfg.save()
 
     def find_title(self, title):
@@ -442,18 +1649,53 @@ class RSSFeedSources(list):
 
 
 class HTMLText(HTMLParser):
-    """Вспомогательный класс для удаления разметки из HTML"""
+    """Вспомогательный класс для удаления разметки из HTML.
+    Текст собирается за один проход по мере разбора: куски - в список,
+    лишние переводы строки и пробелы выкидываются сразу. Если указано
+    ограничение длины текста, разбор прекращается, как только оно
+    превышено - остаток HTML не разбирается вовсе.
+    Экземпляр можно (и лучше) использовать повторно для многих текстов."""
 
     EOLTAGS = set((u'br', u'p'))
 
+    class LimitReached(Exception):
+        pass
+
     def __init__(self, lbchr=u'\n'):
         """Необязательный параметр lbchr содержит строку,
         вставляемую в обработанный текст вместо символа перевода строки.
         По умолчанию - как раз символ перевода строки."""
 
         HTMLParser.__init__(self)
-        self.text = u''
         self.linebreakchar = lbchr
+        self.maxlen = 0
+
+        self.reset_text()
+
+    def reset_text(self):
+        # готовый текст - список кусков и их общая длина
+        self.text = []
+        self.textlen = 0
+        # кол-во строк в тексте (пустые строки исходного текста не в счёт)
+        self.nlines = 0
+        # в текущей строке что-то было (хотя бы пробелы)
+        self.lineStarted = False
+        # в текущей строке уже есть слова
+        self.lineHasWords = False
+        # текущая строка пока кончается пробельным символом
+        self.lineSpace = False
+
+    def add_text(self, s):
+        self.text.append(s)
+        self.textlen += len(s)
+
+        if self.maxlen and self.textlen > self.maxlen:
+            raise self.LimitReached
+
+    def end_line(self):
+        self.lineStarted = False
+        self.lineHasWords = False
+        self.lineSpace = False
 
     def handle_starttag(self, tag, attrs):
         self.handle_startendtag(tag, attrs)
@@ -461,27 +1703,52 @@ class HTMLText(HTMLParser):
     def handle_startendtag(self, tag, attrs):
         tag = tag.lower()
         if tag in self.EOLTAGS:
-            self.text += u'\n'
+            self.end_line()
 
     def handle_data(self, data):
-        self.text += data
+        for ix, s in enumerate(data.split(u'\n')):
+            if ix:
+                self.end_line()
+
+            if not s:
+                continue
+
+            if not self.lineStarted:
+                if self.nlines:
+                    self.add_text(self.linebreakchar)
+
+                self.nlines += 1
+                self.lineStarted = True
 
-    def to_text(self, html):
+            words = s.split()
+
+            if words:
+                # слово могло начаться в предыдущем куске строки
+                if self.lineHasWords and (self.lineSpace or s[0].isspace()):
+                    self.add_text(u' ')
+
+                self.add_text(u' '.join(words))
+                self.lineHasWords = True
+
+            self.lineSpace = s[-1].isspace()
+
+    def to_text(self, html, maxlen=0):
         """Разбирает html, возвращает чистый текст.
-        Символы перевода строки заменяются self.linebreakchar."""
+        Символы перевода строки заменяются self.linebreakchar.
+        Если maxlen > 0 и текст длиннее maxlen символов - возвращаются
+        первые maxlen символов и "...", а остаток html не разбирается."""
 
         # чистим от HTML-разметки
         self.reset()
-        self.feed(html)
-
-        #print self.text
+        self.reset_text()
+        self.maxlen = maxlen
 
-        # чистим от лишних переводов строки
-        t = filter(None, self.text.split(u'\n'))
-        #print t
+        try:
+            self.feed(html)
+        except self.LimitReached:
+            return u''.join(self.text)[:maxlen] + u'...'
 
-        # чистим от лишних пробелов
-        return self.linebreakchar.join(map(lambda s: u' '.join(s.split()), t))
+        return u''.join(self.text)
 
 
 if __name__ == '__main__':
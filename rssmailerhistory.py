@@ -0,0 +1,897 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" rssmailerhistory.py
+
+    Copyright 2013-2020 mc6312
+
+    This file is part of RSSMailer.
+
+    RSSMailer is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RSSMailer is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RSSMailer.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+""" История лент - БД уже отправленных записей, по которой отсеиваются
+    повторы. Хранится либо в текстовых файлах (по файлу на ленту),
+    либо в общей БД sqlite3."""
+
+
+import sqlite3
+import threading
+import struct
+import mmap
+from array import array
+from bisect import bisect_left
+from hashlib import md5
+from collections import namedtuple
+from time import time
+
+from rssmailerconfig import *
+
+
+historyrecord = namedtuple('historyrecord', 'guid link dhash seen')
+# guid  - guid записи из ленты
+# link  - ссылка на запись из ленты (в нижнем регистре; пустая строка,
+#         если ссылки нет или она совпадает с guid)
+# dhash - хэш описания записи (или пустая строка)
+# seen  - время (unix time, целое) первого появления записи
+
+
+def parse_history_record(s, defseen):
+    """Разбирает строку s формата "guid;link;dhash;seen" (из файла истории).
+    Поля, кроме guid, могут отсутствовать (файлы старых версий);
+    если нет поля seen - подставляется defseen.
+    Возвращает экземпляр historyrecord или None, если строка пустая."""
+
+    s = s.strip()
+    if not s:
+        return None
+
+    # не уверен, что guid в rss не может содержать ";", но пока плевать
+    s = list(map(lambda t: t.strip(), s.split(u';')))
+    ls = len(s)
+
+    s_guid = s[0]
+
+    # link
+    if ls > 1 and s[1] and s[1] != s_guid:
+        s_link = s[1].lower() # url'ы вроде бы регистронезависимы?
+    else:
+        s_link = u''
+
+    # description hash
+    s_dhash = s[2] if ls > 2 else u''
+
+    # first seen
+    s_seen = defseen
+    if ls > 3 and s[3]:
+        try:
+            s_seen = int(s[3])
+        except ValueError:
+            pass
+
+    return historyrecord(s_guid, s_link, s_dhash, s_seen)
+
+
+def format_history_record(r):
+    """Возвращает строку (с переводом строки) для записи экземпляра
+    historyrecord r в файл истории."""
+
+    return u'%s;%s;%s;%d\n' % (r.guid, r.link, r.dhash, r.seen)
+
+
+class FeedHistory():
+    """Базовый класс истории одной ленты.
+    Записи, добавленные методом add(), до вызова save() хранятся
+    только в памяти, но при проверках учитываются наравне с сохранёнными.
+    Стараниями разных [censored], генерящих кривые ленты, приходится проверять
+    уникальность не только поля guid, но и link, и хэша описания.
+
+    Если заданы ограничения (maxdays и/или maxrecords), при сохранении
+    из истории выкидываются записи, появившиеся более maxdays дней назад,
+    и/или все записи, кроме maxrecords самых свежих. Записи, встреченные
+    в ленте при текущей загрузке, не выкидываются никогда - иначе они
+    пришли бы снова как новые."""
+
+    def __init__(self, maxdays=0, maxrecords=0):
+        # ограничения на размер истории (0 - без ограничений)
+        self.maxDays = maxdays
+        self.maxRecords = maxrecords
+
+        # guid'ы уже известных записей, встреченных при текущей загрузке
+        self.touchedGuids = set()
+
+        # записи, добавленные при текущем запуске, но ещё не сохранённые
+        # ключи - guid'ы, значения - экземпляры historyrecord
+        self.newRecords = {}
+        # ссылки и хэши, добавленные при текущем запуске
+        # (ссылки - как есть, без приведения к нижнему регистру)
+        self.newLinks = set()
+        self.newHashes = set()
+
+        # записи из писем, ожидающих отправки в очереди (см. rssmailerspool):
+        # в хранилище их ещё нет, но и новыми они уже не считаются
+        self.pendingGuids = set()
+        self.pendingLinks = set()
+        self.pendingHashes = set()
+
+    def add_pending(self, records):
+        """Добавляет записи (экземпляры historyrecord) из очереди
+        неотправленных писем. В хранилище они попадут при сохранении
+        (save(records)) после отправки письма."""
+
+        for r in records:
+            self.pendingGuids.add(r.guid)
+
+            if r.link:
+                self.pendingLinks.add(r.link)
+            if r.dhash:
+                self.pendingHashes.add(r.dhash)
+
+    def load(self):
+        """Подготовка к проверкам (загрузка истории из хранилища).
+        Несохранённые записи при этом выкидываются."""
+
+        self.newRecords.clear()
+        self.newLinks.clear()
+        self.newHashes.clear()
+        self.touchedGuids.clear()
+
+        self.load_storage()
+
+    def has_guid(self, guid):
+        if guid in self.newRecords or guid in self.pendingGuids:
+            return True
+
+        if self.storage_has_guid(guid):
+            self.touchedGuids.add(guid)
+            return True
+
+        return False
+
+    def known_guids(self, guids):
+        """Пакетный вариант has_guid(): возвращает множество уже известных
+        guid'ов из списка guids."""
+
+        known = set(filter(lambda guid: guid in self.newRecords or guid in self.pendingGuids, guids))
+
+        stored = self.storage_known_guids([guid for guid in guids if guid not in known])
+        self.touchedGuids.update(stored)
+
+        return known | stored
+
+    def has_link(self, link):
+        return link in self.newLinks or link in self.pendingLinks or (link and self.storage_has_link(link))
+
+    def has_hash(self, dhash):
+        return dhash in self.newHashes or dhash in self.pendingHashes or self.storage_has_hash(dhash)
+
+    def add(self, guid, link, dhash):
+        """Добавляет запись в историю (пока - только в память).
+        Возвращает экземпляр historyrecord."""
+
+        r = historyrecord(guid, link.lower() if link and link != guid else u'', dhash, int(time()))
+
+        self.newRecords[guid] = r
+        self.newLinks.add(link)
+
+        if dhash:
+            self.newHashes.add(dhash)
+
+        return r
+
+    def save(self, records=None):
+        """Сохраняет в хранилище записи из списка records (экземпляров
+        historyrecord), по умолчанию - все добавленные методом add()."""
+
+        if records is None:
+            records = list(self.newRecords.values())
+
+        # только что сохранённые записи тоже есть в ленте - их не выкидываем
+        self.touchedGuids.update(r.guid for r in records)
+
+        self.store_records(records)
+
+        for r in records:
+            self.newRecords.pop(r.guid, None)
+            self.pendingGuids.discard(r.guid)
+
+    def has_limits(self):
+        return self.maxDays > 0 or self.maxRecords > 0
+
+    def select_evicted(self, records, protected):
+        """Выбирает записи, подлежащие удалению из истории согласно
+        ограничениям.
+        records     - список экземпляров historyrecord
+        protected   - множество guid'ов записей, которые удалять нельзя.
+        Возвращает множество guid'ов."""
+
+        evicted = set()
+
+        if self.maxDays > 0:
+            edge = time() - self.maxDays * 86400
+            evicted.update(r.guid for r in records if r.seen < edge)
+
+        if self.maxRecords > 0 and len(records) > self.maxRecords:
+            evicted.update(r.guid for r in sorted(records, key=lambda r: r.seen, reverse=True)[self.maxRecords:])
+
+        return evicted - protected
+
+    def release(self):
+        """Освобождает ресурсы, которые не нужны после проверок
+        (т.е. после разбора ленты). Сохранять записи после этого можно."""
+
+        pass
+
+    # методы, реализуемые потомками
+    # (storage_known_guids - по желанию, если пакетная проверка дешевле)
+
+    def storage_known_guids(self, guids):
+        return set(filter(self.storage_has_guid, guids))
+
+    def load_storage(self):
+        raise NotImplementedError(u'%s.load_storage()' % self.__class__.__name__)
+
+    def storage_has_guid(self, guid):
+        raise NotImplementedError(u'%s.storage_has_guid()' % self.__class__.__name__)
+
+    def storage_has_link(self, link):
+        raise NotImplementedError(u'%s.storage_has_link()' % self.__class__.__name__)
+
+    def storage_has_hash(self, dhash):
+        raise NotImplementedError(u'%s.storage_has_hash()' % self.__class__.__name__)
+
+    def store_records(self, records):
+        raise NotImplementedError(u'%s.store_records()' % self.__class__.__name__)
+
+
+class HistoryCompactor():
+    """Фоновое уплотнение журналов историй лент (см. FileFeedHistory).
+    Уплотнение выполняется в отдельном потоке, который запускается
+    при появлении работы и завершается, когда работа кончилась.
+    Поток не демонический, т.е. перед выходом из программы
+    начатое уплотнение будет доделано."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = []
+        self.thread = None
+
+    def schedule(self, history):
+        """Ставит историю (экземпляр FileFeedHistory) в очередь на уплотнение."""
+
+        with self.lock:
+            if history in self.queue:
+                return
+
+            self.queue.append(history)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run)
+                self.thread.start()
+
+    def __run(self):
+        # здесь - никаких логов, ибо в сочетании с многопоточностью получается хня
+        while True:
+            with self.lock:
+                if not self.queue:
+                    self.thread = None
+                    return
+
+                history = self.queue.pop(0)
+
+            try:
+                history.compact()
+            except Exception:
+                # не получилось - журнал остаётся как есть, данные не теряются,
+                # уплотнение будет повторено после следующего сохранения
+                pass
+
+    def wait(self):
+        """Ожидание завершения всех запланированных уплотнений."""
+
+        with self.lock:
+            thread = self.thread
+
+        if thread is not None:
+            thread.join()
+
+
+historyCompactor = HistoryCompactor()
+
+
+class FileFeedHistory(FeedHistory):
+    """История ленты в текстовых файлах (по строке "guid;link;dhash;seen"
+    на запись): "основном" файле fname и журнале (fname + ".journal").
+    При сохранении новые записи только дописываются в конец журнала;
+    когда журнал разрастается (более JOURNAL_MIN_SIZE байт и более
+    JOURNAL_MAX_RATIO от размера основного файла), в фоне (см.
+    HistoryCompactor) основной файл перезаписывается вместе с содержимым
+    журнала, а журнал удаляется.
+    При уплотнении же выкидываются записи, не укладывающиеся в ограничения
+    (см. FeedHistory); если таких записей набралось более EVICT_MIN_RATIO
+    от общего кол-ва, уплотнение затевается и без разрастания журнала.
+    Файлы старого формата (без поля seen) читаются, временем появления
+    записей из них считается время изменения файла."""
+
+    JOURNAL_SUFFIX = u'.journal'
+
+    JOURNAL_MIN_SIZE = 65536
+    JOURNAL_MAX_RATIO = 0.25
+
+    EVICT_MIN_RATIO = 0.1
+
+    # блокировки для файлов историй: ключи - имена файлов, значения - threading.Lock
+    # (историй одной ленты в программе может быть несколько)
+    fileLocks = {}
+    fileLocksLock = threading.Lock()
+
+    def __init__(self, fname, maxdays=0, maxrecords=0):
+        FeedHistory.__init__(self, maxdays, maxrecords)
+
+        self.fileName = fname
+        self.journalFileName = fname + self.JOURNAL_SUFFIX
+        self.loaded = False
+
+        with self.fileLocksLock:
+            self.lock = self.fileLocks.setdefault(fname, threading.Lock())
+
+        # данные для проверки на уникальность записи
+        # словарь - для загрузки-сохранения
+        # ключи - guid'ы, значения - экземпляры historyrecord
+        self.guids = {}
+        # и отдельные множества - для проверки (чтоб не лазать вручную в содержимое словаря)
+        self.links = set()
+        # т.к. разные жопорукие постят в ленты одинаковые псто с разными
+        # guid'ами и ссылками, буду проверять еще и по хэшу содержимого
+        self.hashes = set()
+
+        # guid'ы, которые нельзя выкидывать при фоновом уплотнении
+        self.compactProtected = frozenset()
+
+    def load_storage(self):
+        with self.lock:
+            self.guids, self.links, self.hashes = self.read_files((self.fileName, self.journalFileName))
+
+        self.loaded = True
+
+    def read_files(self, fnames):
+        """Файл истории событий. В нем хранятся guid и link.
+        Для совместимости с предыдущей версией при загрузке проверяется
+        кол-во полей в файле.
+        Файлы читаются в порядке их перечисления в fnames (основной файл -
+        перед журналом).
+        Возвращает кортеж из словаря с записями (ключи - guid'ы)
+        и множеств ссылок и хэшей."""
+
+        guids = {}
+        links = set()
+        hashes = set()
+
+        for fname in fnames:
+            if not os.path.isfile(fname):
+                continue
+
+            fseen = int(os.path.getmtime(fname))
+
+            with open(fname, 'r', encoding=IOENCODING) as f:
+                for s in f:
+                    r = parse_history_record(s, fseen)
+                    if r is None:
+                        continue
+
+                    if r.link:
+                        links.add(r.link)
+                    if r.dhash:
+                        hashes.add(r.dhash)
+
+                    guids[r.guid] = r
+
+        return (guids, links, hashes)
+
+    def records(self):
+        """Возвращает итератор по сохранённым записям."""
+
+        return iter(self.guids.values())
+
+    def storage_has_guid(self, guid):
+        return guid in self.guids
+
+    def storage_has_link(self, link):
+        return link in self.links
+
+    def storage_has_hash(self, dhash):
+        return dhash in self.hashes
+
+    def store_records(self, records):
+        """Дописывает записи в журнал; загружать историю для этого
+        не обязательно."""
+
+        if not records:
+            return
+
+        with self.lock:
+            if self.loaded:
+                for r in records:
+                    self.guids[r.guid] = r
+
+                    if r.link:
+                        self.links.add(r.link)
+                    if r.dhash:
+                        self.hashes.add(r.dhash)
+
+            # подкаталог ленты мог ещё не появиться (см. rssmailerfeeds.feed_file_path)
+            jdir = os.path.dirname(self.journalFileName)
+            if jdir and not os.path.isdir(jdir):
+                os.makedirs(jdir, exist_ok=True)
+
+            with open(self.journalFileName, 'a', encoding=IOENCODING) as f:
+                for r in records:
+                    self.__write_record(f, r)
+
+                jsize = f.tell()
+
+            bsize = os.path.getsize(self.fileName) if os.path.isfile(self.fileName) else 0
+
+            needcompact = jsize > self.JOURNAL_MIN_SIZE and jsize > bsize * self.JOURNAL_MAX_RATIO
+
+            if self.has_limits():
+                self.compactProtected = frozenset(self.touchedGuids)
+
+                if not needcompact:
+                    needcompact = self.eviction_needed()
+
+        if needcompact:
+            historyCompactor.schedule(self)
+
+    def eviction_needed(self):
+        """Возвращает True, если записей, не укладывающихся в ограничения,
+        набралось не менее EVICT_MIN_RATIO от общего кол-ва.
+        Вызывается под self.lock."""
+
+        if not self.loaded:
+            return False
+
+        nevicted = len(self.select_evicted(list(self.guids.values()), self.compactProtected))
+        return nevicted > 0 and nevicted >= len(self.guids) * self.EVICT_MIN_RATIO
+
+    def __write_record(self, f, r):
+        f.write(format_history_record(r))
+
+    def compact(self):
+        """Уплотнение: перезапись основного файла вместе с содержимым
+        журнала (без записей, не укладывающихся в ограничения)
+        и удаление журнала."""
+
+        with self.lock:
+            # читаем заново, а не пишем self.guids - файлы могли быть
+            # дописаны другим экземпляром истории той же ленты
+            records = list(self.read_files((self.fileName, self.journalFileName))[0].values())
+
+            if self.has_limits():
+                evicted = self.select_evicted(records, self.compactProtected)
+            else:
+                evicted = set()
+
+            records = [r for r in records if r.guid not in evicted]
+
+            tmpname = self.fileName + u'.tmp'
+            with open(tmpname, 'w+', encoding=IOENCODING) as f:
+                for r in records:
+                    self.__write_record(f, r)
+
+            os.replace(tmpname, self.fileName)
+
+            self.compacted(records)
+
+            # если свалимся до удаления журнала - ничего страшного,
+            # при загрузке повторы просто перезапишут те же записи
+            if os.path.isfile(self.journalFileName):
+                os.remove(self.journalFileName)
+
+    def compacted(self, records):
+        """Вызывается после перезаписи основного файла при уплотнении
+        (под self.lock).
+        records - список записанных в файл экземпляров historyrecord."""
+
+        pass
+
+
+def history_digest(s):
+    """Возвращает 64-битный дайджест (целое) строки s - для компактного
+    хранения guid'ов, ссылок и хэшей (см. CompactFileFeedHistory).
+    Вероятность совпадения дайджестов разных строк в истории одной ленты
+    (при сотнях тысяч записей) - порядка 1e-9."""
+
+    return int.from_bytes(md5(s.encode('utf-8', 'surrogatepass')).digest()[:8], 'little')
+
+
+class DigestArray():
+    """Отсортированный массив 64-битных дайджестов (см. history_digest)
+    с двоичным поиском.
+    items   - отсортированная последовательность целых: array('Q')
+              или memoryview, отображённый на файл индекса."""
+
+    def __init__(self, items):
+        self.items = items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, digest):
+        i = bisect_left(self.items, digest)
+        return i < len(self.items) and self.items[i] == digest
+
+    def count_less(self, v):
+        """Возвращает кол-во элементов, меньших v."""
+
+        return bisect_left(self.items, v)
+
+
+class CompactFileFeedHistory(FileFeedHistory):
+    """История ленты в текстовых файлах (см. FileFeedHistory) с компактным
+    индексом для проверок.
+
+    guid'ы, ссылки и хэши описаний записей из основного файла хранятся
+    в файле индекса (fname + ".idx") в виде отсортированных массивов
+    64-битных дайджестов (см. history_digest), а не множеств строк;
+    при загрузке индекс не читается, а отображается в память (mmap),
+    поиск в нём - двоичный. Строками в памяти держатся только записи
+    из журнала.
+
+    Индекс перестраивается при уплотнении. Если индекса нет, или он
+    не соответствует основному файлу (например, файл изменён версией
+    без индексов) - при загрузке индекс строится в памяти из основного
+    файла, и затевается уплотнение."""
+
+    INDEX_SUFFIX = u'.idx'
+
+    INDEX_MAGIC = b'RSMHIDX' + (b'L' if sys.byteorder == 'little' else b'B')
+    # сигнатура, размер и время изменения (в нс) основного файла,
+    # кол-во guid'ов (и времён появления записей), ссылок, хэшей
+    # за заголовком - массивы (в порядке перечисления; времена появления -
+    # также отсортированные, для оценки кол-ва устаревших записей)
+    INDEX_HEADER = struct.Struct('=8s5Q')
+
+    def __init__(self, fname, maxdays=0, maxrecords=0):
+        FileFeedHistory.__init__(self, fname, maxdays, maxrecords)
+
+        self.indexFileName = fname + self.INDEX_SUFFIX
+
+        self.indexMap = None
+        self.index = None
+        self.release()
+
+    def load_storage(self):
+        rebuilt = False
+
+        with self.lock:
+            self.guids, self.links, self.hashes = self.read_files((self.journalFileName,))
+
+            if not self.open_index():
+                # индекса нет или он устарел
+                records = self.read_files((self.fileName,))[0].values()
+                self.indexGuids, self.indexLinks, self.indexHashes, self.indexSeen = self.make_index_arrays(records)
+
+                rebuilt = len(self.indexGuids) > 0
+
+        self.loaded = True
+
+        if rebuilt:
+            historyCompactor.schedule(self)
+
+    def release(self):
+        """Освобождает загруженный индекс (проверки после этого
+        недоступны до повторной загрузки)."""
+
+        self.indexGuids = self.indexLinks = self.indexHashes = self.indexSeen = DigestArray(array('Q'))
+
+        if self.index is not None:
+            self.index.release()
+            self.index = None
+
+            self.indexMap.close()
+            self.indexMap = None
+
+        self.loaded = False
+
+    def open_index(self):
+        """Отображает файл индекса в память, если он соответствует
+        основному файлу. Возвращает True в случае успеха."""
+
+        if not os.path.isfile(self.indexFileName) or not os.path.isfile(self.fileName):
+            return False
+
+        bstat = os.stat(self.fileName)
+
+        with open(self.indexFileName, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # пустой файл
+                return False
+
+        if len(mm) < self.INDEX_HEADER.size:
+            mm.close()
+            return False
+
+        magic, bsize, bmtime, nguids, nlinks, nhashes = self.INDEX_HEADER.unpack_from(mm)
+
+        if magic != self.INDEX_MAGIC or bsize != bstat.st_size or bmtime != bstat.st_mtime_ns \
+            or len(mm) != self.INDEX_HEADER.size + (nguids * 2 + nlinks + nhashes) * 8:
+            mm.close()
+            return False
+
+        self.indexMap = mm
+        self.index = memoryview(mm)
+
+        def index_array(start, count):
+            return DigestArray(self.index[start:start + count * 8].cast('Q')), start + count * 8
+
+        offset = self.INDEX_HEADER.size
+        self.indexGuids, offset = index_array(offset, nguids)
+        self.indexLinks, offset = index_array(offset, nlinks)
+        self.indexHashes, offset = index_array(offset, nhashes)
+        self.indexSeen, offset = index_array(offset, nguids)
+
+        return True
+
+    def make_index_arrays(self, records):
+        """Возвращает кортеж из экземпляров DigestArray (guid'ы, ссылки,
+        хэши, времена появления) для списка экземпляров historyrecord."""
+
+        guids = array('Q', sorted(history_digest(r.guid) for r in records))
+        links = array('Q', sorted(set(history_digest(r.link) for r in records if r.link)))
+        hashes = array('Q', sorted(set(history_digest(r.dhash) for r in records if r.dhash)))
+        seen = array('Q', sorted(max(r.seen, 0) for r in records))
+
+        return (DigestArray(guids), DigestArray(links), DigestArray(hashes), DigestArray(seen))
+
+    def records(self):
+        # в памяти лежит только журнал - читаем всё с диска
+        with self.lock:
+            return iter(self.read_files((self.fileName, self.journalFileName))[0].values())
+
+    def storage_has_guid(self, guid):
+        return guid in self.guids or history_digest(guid) in self.indexGuids
+
+    def storage_has_link(self, link):
+        return link in self.links or history_digest(link) in self.indexLinks
+
+    def storage_has_hash(self, dhash):
+        return dhash in self.hashes or history_digest(dhash) in self.indexHashes
+
+    def eviction_needed(self):
+        # оценка по индексу (без учёта записей из журнала и совпадений
+        # с защищёнными записями) - чтобы не читать основной файл;
+        # индекс к этому моменту может быть уже освобождён
+        if not self.loaded and not self.open_index():
+            return False
+
+        try:
+            ntotal = len(self.indexGuids)
+            nevicted = 0
+
+            if self.maxDays > 0:
+                nevicted = self.indexSeen.count_less(int(time()) - self.maxDays * 86400)
+
+            if self.maxRecords > 0:
+                nevicted = max(nevicted, ntotal - self.maxRecords)
+
+            nevicted -= len(self.compactProtected)
+
+            return nevicted > 0 and nevicted >= ntotal * self.EVICT_MIN_RATIO
+
+        finally:
+            if not self.loaded:
+                self.release()
+
+    def compacted(self, records):
+        bstat = os.stat(self.fileName)
+
+        arrays = self.make_index_arrays(records)
+
+        tmpname = self.indexFileName + u'.tmp'
+        with open(tmpname, 'wb') as f:
+            f.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC,
+                bstat.st_size, bstat.st_mtime_ns,
+                len(arrays[0]), len(arrays[1]), len(arrays[2])))
+
+            for a in arrays:
+                a.items.tofile(f)
+
+        os.replace(tmpname, self.indexFileName)
+
+
+class SQLiteHistoryDB():
+    """Общая для всех лент БД истории (sqlite3), с индексами по guid,
+    ссылке и хэшу описания.
+    Экземпляр класса может использоваться одновременно несколькими потоками."""
+
+    SCHEMA = u'''CREATE TABLE IF NOT EXISTS feeds (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS history (
+    feed INTEGER NOT NULL REFERENCES feeds(id),
+    guid TEXT NOT NULL,
+    link TEXT NOT NULL,
+    dhash TEXT NOT NULL,
+    seen INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (feed, guid)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS history_link ON history (feed, link);
+CREATE INDEX IF NOT EXISTS history_dhash ON history (feed, dhash);'''
+
+    # имена столбцов, по которым возможен поиск
+    COLUMNS = set((u'guid', u'link', u'dhash'))
+
+    def __init__(self, fname):
+        self.fileName = fname
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(fname, check_same_thread=False)
+        self.conn.execute(u'PRAGMA journal_mode=WAL')
+        self.conn.execute(u'PRAGMA synchronous=NORMAL')
+
+        with self.lock, self.conn:
+            self.conn.executescript(self.SCHEMA)
+
+            # в БД, созданных старыми версиями, нет столбца seen
+            columns = set(map(lambda r: r[1], self.conn.execute(u'PRAGMA table_info(history)')))
+            if u'seen' not in columns:
+                self.conn.execute(u'ALTER TABLE history ADD COLUMN seen INTEGER NOT NULL DEFAULT %d' % int(time()))
+
+            self.conn.execute(u'CREATE INDEX IF NOT EXISTS history_seen ON history (feed, seen)')
+
+    def feed_id(self, url):
+        """Возвращает идентификатор ленты с адресом url (при необходимости
+        добавляя ленту в БД)."""
+
+        with self.lock, self.conn:
+            self.conn.execute(u'INSERT OR IGNORE INTO feeds (url) VALUES (?)', (url,))
+            return self.conn.execute(u'SELECT id FROM feeds WHERE url = ?', (url,)).fetchone()[0]
+
+    def exists(self, feedid, column, value):
+        """Проверяет наличие в истории ленты feedid записи, у которой
+        значение столбца column равно value."""
+
+        if column not in self.COLUMNS:
+            raise ValueError(u'invalid column name "%s"' % column)
+
+        with self.lock:
+            return self.conn.execute(u'SELECT 1 FROM history WHERE feed = ? AND %s = ? LIMIT 1' % column,
+                (feedid, value)).fetchone() is not None
+
+    # макс. кол-во значений в одном запросе "... IN (...)" (у старых
+    # версий sqlite3 ограничение на кол-во параметров запроса - 999)
+    MAX_QUERY_VALUES = 500
+
+    def existing_guids(self, feedid, guids):
+        """Возвращает множество guid'ов из списка guids, имеющихся
+        в истории ленты feedid."""
+
+        found = set()
+
+        with self.lock:
+            for i in range(0, len(guids), self.MAX_QUERY_VALUES):
+                chunk = guids[i:i + self.MAX_QUERY_VALUES]
+
+                found.update(map(lambda r: r[0],
+                    self.conn.execute(u'SELECT guid FROM history WHERE feed = ? AND guid IN (%s)' % u','.join(u'?' * len(chunk)),
+                        [feedid] + chunk)))
+
+        return found
+
+    def insert(self, feedid, records):
+        """Добавляет в историю ленты feedid записи из списка records
+        (экземпляров historyrecord). Уже имеющиеся guid'ы не дублируются."""
+
+        with self.lock, self.conn:
+            self.conn.executemany(u'INSERT OR IGNORE INTO history (feed, guid, link, dhash, seen) VALUES (?, ?, ?, ?, ?)',
+                ((feedid, r.guid, r.link, r.dhash, r.seen) for r in records))
+
+    def evict(self, feedid, maxdays, maxrecords, protected):
+        """Удаляет из истории ленты feedid записи, появившиеся более
+        maxdays дней назад, и все, кроме maxrecords самых свежих
+        (если соотв. параметр больше 0), кроме записей с guid'ами
+        из множества protected."""
+
+        with self.lock, self.conn:
+            evicted = set()
+
+            if maxdays > 0:
+                evicted.update(map(lambda r: r[0], self.conn.execute(u'SELECT guid FROM history WHERE feed = ? AND seen < ?',
+                    (feedid, int(time()) - maxdays * 86400))))
+
+            if maxrecords > 0:
+                evicted.update(map(lambda r: r[0], self.conn.execute(u'SELECT guid FROM history WHERE feed = ? ORDER BY seen DESC LIMIT -1 OFFSET ?',
+                    (feedid, maxrecords))))
+
+            evicted -= protected
+
+            self.conn.executemany(u'DELETE FROM history WHERE feed = ? AND guid = ?',
+                ((feedid, guid) for guid in evicted))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SQLiteFeedHistory(FeedHistory):
+    """История ленты в общей БД (экземпляре SQLiteHistoryDB)."""
+
+    def __init__(self, db, url, maxdays=0, maxrecords=0):
+        FeedHistory.__init__(self, maxdays, maxrecords)
+
+        self.db = db
+        self.url = url
+        self.feedId = None
+
+    def load_storage(self):
+        if self.feedId is None:
+            self.feedId = self.db.feed_id(self.url)
+
+    def storage_has_guid(self, guid):
+        return self.db.exists(self.feedId, u'guid', guid)
+
+    def storage_known_guids(self, guids):
+        return self.db.existing_guids(self.feedId, guids)
+
+    def storage_has_link(self, link):
+        return self.db.exists(self.feedId, u'link', link)
+
+    def storage_has_hash(self, dhash):
+        return self.db.exists(self.feedId, u'dhash', dhash)
+
+    def store_records(self, records):
+        self.load_storage()
+        self.db.insert(self.feedId, records)
+
+        if self.has_limits():
+            self.db.evict(self.feedId, self.maxDays, self.maxRecords, self.touchedGuids)
+
+
+__historyDBs = {}
+__historyDBsLock = threading.Lock()
+
+
+def open_history_db(fname):
+    """Возвращает экземпляр SQLiteHistoryDB для файла fname
+    (один на файл на всё время работы)."""
+
+    with __historyDBsLock:
+        db = __historyDBs.get(fname)
+        if db is None:
+            db = SQLiteHistoryDB(fname)
+            __historyDBs[fname] = db
+
+        return db
+
+
+def feed_history(env, url, fname, maxdays=None, maxrecords=None):
+    """Создаёт историю ленты в соответствии с настройками env.
+    url         - адрес ленты (ключ в общей БД)
+    fname       - имя файла истории (для хранения в текстовых файлах)
+    maxdays, maxrecords - ограничения на размер истории (см. FeedHistory);
+                  если None - берутся из настроек env."""
+
+    if maxdays is None:
+        maxdays = env.settHistoryDays
+    if maxrecords is None:
+        maxrecords = env.settHistoryMax
+
+    if env.settHistory == HISTORY_SQLITE:
+        return SQLiteFeedHistory(open_history_db(env.historyDBFileName), url, maxdays, maxrecords)
+    elif env.settHistoryCompact:
+        return CompactFileFeedHistory(fname, maxdays, maxrecords)
+    else:
+        return FileFeedHistory(fname, maxdays, maxrecords)
@@ -20,42 +20,233 @@
     You should have received a copy of the GNU General Public License
     along with RSSMailer.  If not, see <http://www.gnu.org/licenses/>."""
 
-from smtplib import SMTP, SMTPException
+from smtplib import SMTP, LMTP, SMTPException, SMTPServerDisconnected, SMTPResponseException,\
+    SMTPSenderRefused, SMTPRecipientsRefused, SMTPDataError
 from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-from email.mime.text import MIMEText
+from email.mime.base import MIMEBase
+from base64 import encodebytes
 from datetime import datetime
+from uuid import uuid4
 from os.path import isfile, basename
 from os import stat
+from tempfile import TemporaryFile
+import mailbox
+import io
+import re
+import subprocess
+import shlex
+import threading
+import queue
 
 from rssmailerconfig import *
 
 
-def send_message(env, subject, textbody, htmlbody, attachfiles=[]):
-    """Отправляет письмо по адресам, указанным в настройках env
-    (см. rssmailerconfig).
+# сколько байт исходных данных кодируется в base64 за раз
+# (кратно 57 - столько байт в строке base64 из 76 символов)
+STREAM_CHUNK_SIZE = 57 * 1024
+
+# для передачи письма командой DATA (см. SMTPSession.send_data())
+EOL_RX = re.compile(br'(?:\r\n|\n|\r(?!\n))')
+LEADING_DOT_RX = re.compile(br'(?m)^\.')
+
+
+class MessageStream():
+    """Базовый класс письма, которое не собирается в памяти целиком,
+    а выдаётся по кускам генератором chunks() - при передаче серверу,
+    записи в файл и т.п. Куски - bytes, каждый кусок состоит из целых
+    строк с концами строк b'\\n'. Генератор можно вызывать повторно
+    (например, при повторной отправке)."""
+
+    def chunks(self):
+        raise NotImplementedError
+
+    def as_bytes(self):
+        """Письмо целиком (для маленьких писем и отладки)."""
+
+        return b''.join(self.chunks())
+
+    def write_to(self, f):
+        """Записывает письмо в файл f (открытый в двоичном режиме)."""
+
+        for chunk in self.chunks():
+            f.write(chunk)
+
+    def reader(self):
+        """Возвращает объект, подобный двоичному файлу, из которого
+        письмо можно читать (в т.ч. построчно, для модуля mailbox)."""
+
+        return io.BufferedReader(ChunkReader(self.chunks()), STREAM_CHUNK_SIZE)
+
+
+class ChunkReader(io.RawIOBase):
+    """Чтение кусков из итератора chunks как из файла."""
+
+    def __init__(self, chunks):
+        super().__init__()
+
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            self.buffer = next(self.chunks, None)
+            if self.buffer is None:
+                self.buffer = b''
+                return 0
+
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+
+        return n
+
+
+def base64_chunks(datachunks):
+    """Генератор: кодирует в base64 (строками по 76 символов) данные,
+    которые выдаёт итератор datachunks (bytes) по кускам."""
+
+    carry = b''
+
+    for data in datachunks:
+        if carry:
+            data = carry + data
+
+        # неполная строка доедет со следующим куском
+        n = len(data) - len(data) % 57
+        carry = data[n:]
+
+        if n:
+            yield encodebytes(data[:n])
+
+    if carry:
+        yield encodebytes(carry)
+
+
+def text_data_chunks(text, charset):
+    """Генератор: кодирует строку text в charset по кускам."""
+
+    for ix in range(0, len(text), STREAM_CHUNK_SIZE):
+        yield text[ix:ix + STREAM_CHUNK_SIZE].encode(charset, 'replace')
+
+
+def file_data_chunks(fname):
+    """Генератор: читает файл fname по кускам."""
+
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(STREAM_CHUNK_SIZE)
+            if not data:
+                return
+
+            yield data
+
+
+class MIMEMessageStream(MessageStream):
+    """Письмо в формате MIME (multipart/mixed с частями в base64),
+    см. make_message(). Текст кодируется, а приложенные файлы читаются
+    с диска по кускам - по мере выдачи письма."""
+
+    def __init__(self, headers, boundary, charset, textbody, htmlbody, attachfiles):
+        # заголовки письма (bytes, с пустой строкой в конце)
+        self.headers = headers
+        self.boundary = boundary.encode('ascii')
+        self.charset = charset
+        self.textbody = textbody
+        self.htmlbody = htmlbody
+        self.attachfiles = attachfiles
+
+    def part_chunks(self, part, datachunks):
+        """Генератор: часть письма с заголовками из part (экземпляр
+        MIMEBase без содержимого) и содержимым, которое выдаёт итератор
+        datachunks."""
+
+        # заголовки - средствами модуля email (он же кодирует
+        # не-ASCII параметры вроде имён файлов - см. RFC 2231)
+        part['Content-Transfer-Encoding'] = 'base64'
+
+        headers = part.as_bytes()
+
+        yield b''.join((b'--', self.boundary, b'\n', headers[:headers.index(b'\n\n') + 2]))
+
+        yield from base64_chunks(datachunks)
+
+    def chunks(self):
+        yield self.headers
+
+        if self.textbody:
+            yield from self.part_chunks(MIMEBase('text', 'plain', charset=self.charset),
+                text_data_chunks(self.textbody, self.charset))
+
+        if self.htmlbody:
+            yield from self.part_chunks(MIMEBase('text', 'html', charset=self.charset),
+                text_data_chunks(self.htmlbody, self.charset))
+
+        for attachfname in self.attachfiles:
+            part = MIMEBase('application', 'octet-stream')
+            part.add_header('Content-Disposition', 'attachment', filename=basename(attachfname))
+
+            yield from self.part_chunks(part, file_data_chunks(attachfname))
+
+        yield b''.join((b'--', self.boundary, b'--\n'))
+
+
+class FileMessageStream(MessageStream):
+    """Уже готовое письмо из файла fname (например, из очереди
+    неотправленных писем)."""
+
+    def __init__(self, fname):
+        self.fileName = fname
+
+    def chunks(self):
+        carry = b''
+
+        for data in file_data_chunks(self.fileName):
+            data = carry + data
+
+            # куски - из целых строк
+            n = data.rfind(b'\n') + 1
+            carry = data[n:]
+
+            if n:
+                yield data[:n]
+
+        if carry:
+            yield carry + b'\n'
+
+
+def make_message(env, subject, textbody, htmlbody, attachfiles=[], mailto=None):
+    """Создаёт письмо в формате MIME для отправки по адресам, указанным
+    в настройках env (см. rssmailerconfig).
     subject     - строка с заголовком письма
     textbody    - plain text - содержимое письма (м.б. None)
     htmlbody    - HTML - содержимое письма (м.б. None)
     attachfiles - список имен файлов, которые следует приложить к письму
-    Возвращает булевское значение с результатом отправки."""
+    mailto      - список адресов получателей (если None - env.mailTo)
+    Возвращает экземпляр MIMEMessageStream - письмо собирается по кускам
+    при отправке (см. MessageStream)."""
 
-    env.logger.debug(u'preparing to send email')
-    #
-    # создаем сообщение в формате MIME
-    #
+    # заголовки - средствами модуля email, а части письма
+    # выдаёт MIMEMessageStream
     msg = MIMEMultipart()
     msg.set_charset(env.mailCharset)
     msg['Subject'] = subject
     msg['From'] = env.mailFrom
-    msg['To'] = u', '.join(env.mailTo)
+    msg['To'] = u', '.join(mailto if mailto else env.mailTo)
     msg['Date'] = datetime.now().strftime('%a, %d %b %Y %H:%M:%S %z')
 
-    if textbody:
-        msg.attach(MIMEText(textbody.encode(env.mailCharset, 'replace'), 'plain', env.mailCharset))
+    # в base64 символа "_" нет, так что граница в тексте не встретится
+    boundary = u'=_rssmailer_%s' % uuid4().hex
+    msg.set_boundary(boundary)
+    # set_charset() добавляет его и к multipart, чего быть не должно
+    del msg['Content-Transfer-Encoding']
+
+    headers = msg.as_bytes()
+    headers = headers[:headers.index(b'\n\n') + 2]
 
-    if htmlbody:
-        msg.attach(MIMEText(htmlbody.encode(env.mailCharset, 'replace'), 'html', env.mailCharset))
+    attachments = []
 
     for attachfname in attachfiles:
         if not isfile(attachfname):
@@ -66,41 +257,585 @@ def send_message(env, subject, textbody, htmlbody, attachfiles=[]):
             env.logger.warning(u'can not attach empty file "%s"' % attachfname)
             continue
 
-        with open(attachfname, 'rb') as fp:
-            fd = fp.read()
+        attachments.append(attachfname)
+
+    return MIMEMessageStream(headers, boundary, env.mailCharset, textbody, htmlbody, attachments)
+
+
+class MailSession():
+    """Базовый класс сеанса доставки писем. Письма доставляются методом
+    send(), сеанс открывается при доставке первого письма (методом
+    connect()) и закрывается методом close().
+    Использовать лучше через with, чтобы сеанс закрылся."""
+
+    def __init__(self, env):
+        self.env = env
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send(self, msg, mailto=None):
+        """Доставляет письмо msg (экземпляр MessageStream или уже готовое
+        письмо в виде bytes) по адресам из списка mailto
+        (если None - env.mailTo).
+        Возвращает булевское значение с результатом доставки."""
+
+        raise NotImplementedError
+
+    def send_message(self, subject, textbody, htmlbody, attachfiles=[]):
+        """Создаёт (см. make_message) и доставляет письмо.
+        Возвращает булевское значение с результатом доставки."""
+
+        self.env.logger.debug(u'preparing to send email')
+
+        return self.send(make_message(self.env, subject, textbody, htmlbody, attachfiles))
+
+
+class SMTPSession(MailSession):
+    """Сеанс SMTP на всю рассылку: соединение (с STARTTLS и аутентификацией)
+    устанавливается при отправке первого письма и используется повторно.
+    После env.mailMaxMessages писем (если не 0) соединение открывается
+    заново - некоторые серверы не любят слишком длинных сеансов.
+    Если сервер закрыл соединение между письмами - оно открывается
+    заново, и отправка повторяется.
+    Использовать лучше через with, чтобы соединение закрылось."""
+
+    # код ответа "421 Service not available, closing transmission channel"
+    SMTP_SERVICE_NOT_AVAILABLE = 421
+
+    def __init__(self, env):
+        super().__init__(env)
+
+        self.smtp = None
+        # кол-во писем, отправленных через текущее соединение
+        self.nSent = 0
+
+    def make_connection(self):
+        """Устанавливает соединение с сервером, возвращает экземпляр
+        smtplib.SMTP."""
+
+        self.env.logger.debug(u'connecting to %s' % self.env.mailHost)
+        smtp = SMTP(self.env.mailHost)#, None, None, 1)
+
+        try:
+            smtp.set_debuglevel(0)
+
+            if self.env.mailTLS:
+                self.env.logger.debug(u'trying to start TLS')
+                smtp.starttls()
+
+            if self.env.mailPassword:
+                self.env.logger.debug(u'authentication')
+                smtp.login(self.env.mailLogin, self.env.mailPassword)
+
+        except Exception:
+            smtp.close()
+            raise
+
+        return smtp
+
+    def connect(self):
+        self.smtp = self.make_connection()
+        self.nSent = 0
+
+    def close(self):
+        """Закрывает соединение (если оно открыто)."""
+
+        if self.smtp is None:
+            return
+
+        smtp = self.smtp
+        self.smtp = None
+
+        try:
+            smtp.quit()
+        except (SMTPException, OSError):
+            # сервер мог уже закрыть соединение сам - не страшно
+            smtp.close()
+
+    def send(self, msg, mailto=None):
+        """Отправляет письмо msg (экземпляр MessageStream или уже готовое
+        письмо в виде bytes) от env.mailFrom по адресам из списка mailto
+        (если None - env.mailTo).
+        Возвращает булевское значение с результатом отправки."""
+
+        if not mailto:
+            mailto = self.env.mailTo
+
+        try:
+            if self.smtp is not None and self.env.mailMaxMessages and self.nSent >= self.env.mailMaxMessages:
+                self.env.logger.debug(u'%d messages sent over connection, reconnecting' % self.nSent)
+                self.close()
+
+            while True:
+                reused = self.smtp is not None
+                if not reused:
+                    self.connect()
+
+                try:
+                    self.env.logger.debug(u'sending email from %s to %s' % (self.env.mailFrom, mailto))
+                    self.transfer(msg, mailto)
+                    break
+
+                except OSError as ex:
+                    # повторяем только если соединение было не свежее
+                    # и отвалилось (а не сервер отказался принять письмо)
+                    if not reused or not self.connection_lost(ex):
+                        raise
+
+                    self.env.logger.debug(u'connection lost (%s), reconnecting' % str(ex))
+                    self.close()
+
+            self.nSent += 1
+            self.env.logger.debug(u'email sent')
+            return True
+
+        except SMTPException as ex:
+            self.env.logger.error(u'SMTP error: %s' % str(ex))
+
+            # после ошибки состояние сеанса неизвестно - начнём следующий заново
+            self.close()
+            return False
+
+    def connection_lost(self, ex):
+        """Возвращает True, если исключение ex означает обрыв соединения
+        (после которого письмо имеет смысл отправить заново через новое)."""
+
+        if isinstance(ex, SMTPServerDisconnected):
+            return True
 
-        payload = MIMEApplication(fd)
-        payload['Content-Disposition'] = 'attachment; filename="%s"' % basename(attachfname)
-        msg.attach(payload)
+        if isinstance(ex, SMTPResponseException):
+            return ex.smtp_code == self.SMTP_SERVICE_NOT_AVAILABLE
 
-    #
-    # отправляем
-    #
-    try:
-        env.logger.debug(u'trying to send email over %s' % env.mailHost)
-        smtp = SMTP(env.mailHost)#, None, None, 1)
+        # SMTPException - производное от OSError, но это отказ сервера
+        # (получатели, DATA и т.п.) или ошибка письма, а не обрыв
+        return not isinstance(ex, SMTPException)
 
-        smtp.set_debuglevel(0)
+    def start_transaction(self, mailto):
+        """Начинает передачу письма получателям из списка mailto
+        (команды MAIL FROM и RCPT TO).
+        Возвращает кортеж из двух элементов: список принятых сервером
+        получателей и словарь отвергнутых (ключи - адреса, значения -
+        кортежи (код, ответ сервера)).
+        Если сервер отверг отправителя или всех получателей - генерирует
+        исключение SMTPException."""
 
-        #smtp.connect()
-        if env.mailTLS:
-            env.logger.debug(u'trying to start TLS')
-            smtp.starttls()
+        smtp = self.smtp
 
-        if env.mailPassword:
-            env.logger.debug(u'authentication')
-            smtp.login(env.mailLogin, env.mailPassword)
+        smtp.ehlo_or_helo_if_needed()
 
-        env.logger.debug(u'sending email from %s to %s' % (env.mailFrom, env.mailTo))
-        smtp.sendmail(env.mailFrom, env.mailTo, msg.as_string())
+        code, resp = smtp.mail(self.env.mailFrom)
+        if code != 250:
+            smtp.rset()
+            raise SMTPSenderRefused(code, resp, self.env.mailFrom)
 
-        smtp.quit()
-        env.logger.debug(u'email sent')
+        accepted = []
+        refused = {}
+
+        for rcpt in mailto:
+            code, resp = smtp.rcpt(rcpt)
+            if code in (250, 251):
+                accepted.append(rcpt)
+            else:
+                refused[rcpt] = (code, resp)
+
+        if not accepted:
+            smtp.rset()
+            raise SMTPRecipientsRefused(refused)
+
+        return accepted, refused
+
+    def send_data(self, msg):
+        """Передаёт серверу письмо msg (см. send()) командой DATA.
+        Письмо (экземпляр MessageStream) передаётся по кускам,
+        не собираясь в памяти целиком.
+        Возвращает кортеж (код, ответ сервера) на окончание DATA."""
+
+        smtp = self.smtp
+
+        if isinstance(msg, bytes):
+            return smtp.data(msg)
+
+        smtp.putcmd('data')
+        code, resp = smtp.getreply()
+        if code != 354:
+            raise SMTPDataError(code, resp)
+
+        # то же, что делает smtplib.SMTP.data(), но по кускам; куски -
+        # из целых строк, так что строки на стыках кусков не разрываются
+        chunks = msg.chunks()
+
+        while True:
+            try:
+                chunk = next(chunks, None)
+            except Exception as ex:
+                # письмо не удалось собрать (например, приложенный файл
+                # пропал) посреди DATA: сервер ждёт продолжения письма,
+                # и QUIT/RSET он примет за его текст - соединение
+                # просто бросаем, чтобы недописанное письмо не ушло
+                self.smtp = None
+                smtp.close()
+                raise SMTPException(u'can not make message: %s' % str(ex))
+
+            if chunk is None:
+                break
+
+            smtp.send(LEADING_DOT_RX.sub(b'..', EOL_RX.sub(b'\r\n', chunk)))
+
+        smtp.send(b'.\r\n')
+
+        return smtp.getreply()
+
+    def transfer(self, msg, mailto):
+        """Передаёт серверу письмо msg (см. send()) для получателей
+        из списка mailto.
+        В случае ошибки генерирует исключение SMTPException."""
+
+        self.start_transaction(mailto)
+
+        code, resp = self.send_data(msg)
+        if code != 250:
+            if code != self.SMTP_SERVICE_NOT_AVAILABLE:
+                self.smtp.rset()
+            raise SMTPDataError(code, resp)
+
+
+class LMTPSession(SMTPSession):
+    """Сеанс LMTP с локальным MTA (через unix-сокет, если env.mailLMTPHost -
+    путь, или по сети - на порт env.mailLMTPPort). В отличие от SMTP, сервер отвечает на DATA
+    отдельно по каждому получателю, и письмо сразу попадает в ящики,
+    а не в очередь MTA.
+    Письмо считается доставленным, если его принял хотя бы один
+    получатель (как и при отправке через SMTP); об остальных пишется
+    в лог."""
+
+    def make_connection(self):
+        self.env.logger.debug(u'connecting to LMTP server %s' % self.env.mailLMTPHost)
+        # для unix-сокета порт не учитывается
+        return LMTP(self.env.mailLMTPHost, self.env.mailLMTPPort)
+
+    def transfer(self, msg, mailto):
+        accepted, refused = self.start_transaction(mailto)
+
+        # smtplib.data() читает только первый ответ, а LMTP-сервер
+        # отвечает на DATA по каждому принятому получателю
+        replies = [self.send_data(msg)]
+        replies += [self.smtp.getreply() for rcpt in accepted[1:]]
+
+        delivered = 0
+
+        for rcpt, (code, resp) in zip(accepted, replies):
+            if code == 250:
+                delivered += 1
+            else:
+                refused[rcpt] = (code, resp)
+
+        for rcpt, (code, resp) in refused.items():
+            self.env.logger.error(u'LMTP: delivery to %s failed: %d %s' % (rcpt, code,
+                resp.decode(IOENCODING, 'replace') if isinstance(resp, bytes) else resp))
+
+        if not delivered:
+            raise SMTPDataError(code, resp)
+
+
+class LocalMailboxSession(MailSession):
+    """Базовый класс сеанса локальной доставки в почтовый ящик
+    env.mailMailbox (см. модуль mailbox) - без SMTP-сервера, простой
+    записью файлов. Заголовки письма остаются теми же, что и при отправке
+    через SMTP; получатели (mailto) не учитываются - ящик один."""
+
+    def __init__(self, env):
+        super().__init__(env)
+
+        self.mailbox = None
+
+    def open_mailbox(self):
+        """Возвращает экземпляр mailbox.Mailbox."""
+
+        raise NotImplementedError
+
+    def connect(self):
+        self.env.logger.debug(u'opening mailbox %s' % self.env.mailMailbox)
+        self.mailbox = self.open_mailbox()
+
+    def close(self):
+        if self.mailbox is not None:
+            mbox = self.mailbox
+            self.mailbox = None
+            mbox.close()
+
+    def add_message(self, msg):
+        # модуль mailbox читает письмо из файла построчно
+        self.mailbox.add(msg if isinstance(msg, bytes) else msg.reader())
+
+    def send(self, msg, mailto=None):
+        try:
+            if self.mailbox is None:
+                self.connect()
+
+            self.add_message(msg)
+
+            self.env.logger.debug(u'email delivered to %s' % self.env.mailMailbox)
+            return True
+
+        except (mailbox.Error, OSError) as ex:
+            self.env.logger.error(u'mailbox error: %s' % str(ex))
+
+            self.close()
+            return False
+
+
+class MaildirSession(LocalMailboxSession):
+    """Доставка в каталог Maildir: каждое письмо пишется в отдельный файл
+    в подкаталоге tmp и переносится в new, так что почтовый клиент
+    не увидит недописанных писем. Потоки друг другу не мешают."""
+
+    def open_mailbox(self):
+        return mailbox.Maildir(self.env.mailMailbox, factory=None, create=True)
+
+
+class MboxSession(LocalMailboxSession):
+    """Доставка в файл mbox: письма дописываются в конец файла
+    под блокировкой (и от других процессов, и от других потоков)."""
+
+    # файловые блокировки mailbox.mbox работают только между процессами
+    threadLock = threading.Lock()
+
+    def open_mailbox(self):
+        return mailbox.mbox(self.env.mailMailbox, factory=None, create=True)
+
+    def add_message(self, msg):
+        with self.threadLock:
+            self.mailbox.lock()
+            try:
+                self.mailbox.add(msg if isinstance(msg, bytes) else msg.reader())
+                self.mailbox.flush()
+            finally:
+                self.mailbox.unlock()
+
+
+class SendmailSession(MailSession):
+    """Доставка программой, совместимой с "sendmail -t" (команда
+    env.mailSendmail): письмо целиком передаётся ей в stdin, получатели
+    берутся из заголовков (mailto не учитывается - см. make_message()).
+    Один процесс на письмо - пачку писем "sendmail -t"
+    за раз не принимает; письма передаются параллельно, если потоков
+    отправки (env.mailConnections) больше одного."""
+
+    def __init__(self, env):
+        super().__init__(env)
+
+        self.command = shlex.split(env.mailSendmail)
+
+    def send(self, msg, mailto=None):
+        self.env.logger.debug(u'piping email to %s' % self.command[0])
+
+        # stderr - во временный файл: пока письмо пишется в stdin,
+        # его никто не читает, и заполненный канал stderr повесил бы обоих
+        with TemporaryFile() as ferr:
+            try:
+                proc = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL, stderr=ferr)
+
+                try:
+                    if isinstance(msg, bytes):
+                        proc.stdin.write(msg)
+                    else:
+                        msg.write_to(proc.stdin)
+                except Exception:
+                    # недописанное письмо отправлять нельзя
+                    proc.kill()
+                    raise
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except OSError:
+                        pass
+
+                    try:
+                        proc.wait(MAIL_SENDMAIL_TIMEOUT)
+                    except subprocess.TimeoutExpired:
+                        proc.kill()
+                        proc.wait()
+                        raise
+
+            except (OSError, subprocess.SubprocessError) as ex:
+                self.env.logger.error(u'sendmail error: %s' % str(ex))
+                return False
+
+            if proc.returncode != 0:
+                ferr.seek(0)
+                serr = ferr.read().decode(IOENCODING, 'replace').strip()
+
+                self.env.logger.error(u'sendmail error: exit code %d%s' % (proc.returncode,
+                    u'' if not serr else u' (%s)' % serr))
+                return False
+
+        self.env.logger.debug(u'email sent')
         return True
 
-    except SMTPException as ex:
-        env.logger.error(u'SMTP error: %s' % str(ex))
-        return False
+
+MAIL_SESSIONS = {MAIL_DELIVERY_SMTP:SMTPSession,
+    MAIL_DELIVERY_MAILDIR:MaildirSession,
+    MAIL_DELIVERY_MBOX:MboxSession,
+    MAIL_DELIVERY_LMTP:LMTPSession,
+    MAIL_DELIVERY_SENDMAIL:SendmailSession}
+
+
+def mail_session(env):
+    """Возвращает новый сеанс доставки писем (экземпляр класса,
+    производного от MailSession) согласно env.mailDelivery."""
+
+    return MAIL_SESSIONS[env.mailDelivery](env)
+
+
+class MailSenderThread(threading.Thread):
+    """Поток-отправщик со своим сеансом доставки (см. mail_session()).
+    Берёт из очереди jobqueue пачки писем - списки кортежей (письмо, метка,
+    получатели), пока не встретит None; письма пачки отправляются подряд
+    через одно соединение. Результат отправки каждого письма кладёт
+    в очередь resultqueue кортежем (письмо, метка, булевское значение)."""
+
+    def __init__(self, env, jobqueue, resultqueue):
+        threading.Thread.__init__(self)
+        self.env = env
+        self.jobqueue = jobqueue
+        self.resultqueue = resultqueue
+
+    def run(self):
+        with mail_session(self.env) as session:
+            while True:
+                batch = self.jobqueue.get()
+                if batch is None:
+                    return
+
+                for msg, tag, mailto in batch:
+                    try:
+                        sent = session.send(msg, mailto)
+                    except Exception as ex:
+                        # например, сервер недоступен - но остальные письма
+                        # пусть пытаются отправиться
+                        self.env.logger.error(u'error sending email: %s' % str(ex))
+                        session.close()
+                        sent = False
+
+                    self.resultqueue.put((msg, tag, sent))
+
+
+class MailSender():
+    """Отправка писем пулом из env.mailConnections потоков, у каждого -
+    своё соединение с SMTP-сервером или свой локальный почтовый ящик
+    (см. MailSenderThread).
+    Письма ставятся в очередь методами submit() и submit_batch(),
+    результаты отправки забираются методом results() (в порядке
+    завершения отправки).
+    Если maxqueue > 0 - в очереди может быть не более maxqueue пачек писем,
+    submit() при заполненной очереди ждёт.
+    submit() и submit_batch() можно вызывать из разных потоков
+    (например, из потока вёрстки в режиме конвейера)."""
+
+    def __init__(self, env, maxqueue=0):
+        self.env = env
+
+        self.jobqueue = queue.Queue(maxqueue)
+        self.resultqueue = queue.Queue()
+
+        # кол-во писем, результат отправки которых ещё не забран
+        self.pending = 0
+        # кол-во поставленных в очередь пачек
+        self.nBatches = 0
+
+        self.senders = []
+
+        # для pending, nBatches и senders
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, msg, tag=None, mailto=None):
+        """Ставит в очередь на отправку письмо msg (см. MailSession.send())
+        по адресам из списка mailto (если None - env.mailTo).
+        tag - произвольное значение, которое вернёт results() вместе
+        с результатом отправки."""
+
+        self.submit_batch([(msg, tag, mailto)])
+
+    def submit_batch(self, batch):
+        """Ставит в очередь на отправку пачку писем - список кортежей
+        (письмо, метка, получатели), см. submit(). Письма пачки отправляются
+        подряд одним потоком через одно соединение."""
+
+        if not batch:
+            return
+
+        with self.lock:
+            self.nBatches += 1
+
+            # потоки запускаются по мере надобности, но не более mailConnections
+            if len(self.senders) < min(self.env.mailConnections, self.nBatches):
+                t = MailSenderThread(self.env, self.jobqueue, self.resultqueue)
+                self.senders.append(t)
+                t.start()
+
+            self.pending += len(batch)
+
+        # при заполненной очереди put() ждёт - не под блокировкой
+        self.jobqueue.put(batch)
+
+    def results(self):
+        """Генератор, выдающий кортежи (письмо, метка, булевское значение
+        с результатом отправки) для всех поставленных в очередь писем."""
+
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+
+            r = self.resultqueue.get()
+
+            with self.lock:
+                self.pending -= 1
+
+            yield r
+
+    def close(self):
+        """Завершает потоки-отправщики (после отправки уже поставленных
+        в очередь писем)."""
+
+        with self.lock:
+            senders = self.senders[:]
+
+        for t in senders:
+            self.jobqueue.put(None)
+
+        for t in senders:
+            t.join()
+
+        with self.lock:
+            del self.senders[:]
+
+
+def send_message(env, subject, textbody, htmlbody, attachfiles=[]):
+    """Отправляет письмо по адресам, указанным в настройках env
+    (см. rssmailerconfig), через отдельный сеанс доставки.
+    Параметры - см. make_message().
+    Возвращает булевское значение с результатом отправки."""
+
+    with mail_session(env) as session:
+        return session.send_message(subject, textbody, htmlbody, attachfiles)
 
 #
 # test
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" rssmailerspool.py
+
+    Copyright 2013-2020 mc6312
+
+    This file is part of RSSMailer.
+
+    RSSMailer is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    RSSMailer is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with RSSMailer.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+""" Очередь (spool) неотправленных писем.
+    Письмо, которое не удалось отправить, сохраняется вместе с записями
+    истории ленты, которые надо сохранить после его отправки; при следующих
+    запусках отправка повторяется (с увеличивающимися интервалами),
+    а лента не скачивается и не верстается заново ради тех же новостей -
+    записи из очереди считаются уже известными."""
+
+
+import os.path
+from time import time
+
+from rssmailerconfig import *
+from rssmailerhistory import parse_history_record, format_history_record
+from rssmailersender import FileMessageStream
+
+
+class SpoolEntry():
+    """Письмо в очереди: файлы name + ".eml" (письмо целиком, в том виде,
+    в каком оно отправляется) и name + ".rec" (заголовок "параметр: значение"
+    и после пустой строки - блоки записей истории, разделённые пустыми
+    строками; в первой строке блока - "url: адрес ленты", дальше - записи
+    в формате файлов истории).
+    В одном письме (сводке) могут быть новости нескольких лент."""
+
+    def __init__(self, spool, name, feeds, attempts=0, nexttry=0, mailto=None):
+        self.spool = spool
+        self.name = name
+        # словарь, где ключи - адреса лент, а значения - списки
+        # экземпляров historyrecord
+        self.feeds = feeds
+        # список адресов получателей (если None - из общих настроек)
+        self.mailTo = mailto
+        # кол-во неудачных попыток отправки
+        self.attempts = attempts
+        # время (unix time) следующей попытки
+        self.nextTry = nexttry
+
+    def message(self):
+        """Возвращает письмо (экземпляр FileMessageStream - письмо
+        читается из файла по кускам при отправке)."""
+
+        return FileMessageStream(self.spool.entry_file_name(self.name, self.spool.EML_SUFFIX))
+
+
+class MailSpool():
+    """Очередь неотправленных писем в каталоге dirname.
+    Как в maildir: файлы пишутся в подкаталог tmp, а готовые переносятся
+    (переименованием) в подкаталог new, так что при падении посреди записи
+    в очереди не окажется недописанных писем.
+    Признак того, что письмо в очереди - наличие файла .rec в new
+    (он переносится туда последним)."""
+
+    TMP_DIR = u'tmp'
+    NEW_DIR = u'new'
+
+    EML_SUFFIX = u'.eml'
+    REC_SUFFIX = u'.rec'
+
+    PARAM_URL = u'url'
+    PARAM_ATTEMPTS = u'attempts'
+    PARAM_NEXTTRY = u'next-try'
+    PARAM_TO = u'to'
+
+    # интервал между попытками отправки (в секундах) после первой
+    # неудачной попытки; удваивается после каждой следующей, но не более
+    # RETRY_DELAY_MAX
+    RETRY_DELAY = 300
+    RETRY_DELAY_MAX = 6 * 3600
+
+    def __init__(self, dirname):
+        self.dirName = dirname
+        self.tmpDir = os.path.join(dirname, self.TMP_DIR)
+        self.newDir = os.path.join(dirname, self.NEW_DIR)
+
+        # письма в очереди (экземпляры SpoolEntry)
+        self.entries = []
+
+        self.nameCounter = 0
+
+    def entry_file_name(self, name, suffix, tmp=False):
+        return os.path.join(self.tmpDir if tmp else self.newDir, name + suffix)
+
+    def make_dirs(self):
+        for dname in (self.tmpDir, self.newDir):
+            if not os.path.isdir(dname):
+                os.makedirs(dname)
+
+    def load(self):
+        """Загружает список писем в очереди. Недописанные файлы
+        (оставшиеся в tmp) и письма без .rec выкидываются."""
+
+        del self.entries[:]
+
+        if os.path.isdir(self.tmpDir):
+            for fname in os.listdir(self.tmpDir):
+                os.remove(os.path.join(self.tmpDir, fname))
+
+        if not os.path.isdir(self.newDir):
+            return
+
+        fnames = os.listdir(self.newDir)
+
+        for fname in fnames:
+            if fname.endswith(self.REC_SUFFIX):
+                entry = self.read_entry(fname[:-len(self.REC_SUFFIX)])
+                if entry is not None:
+                    self.entries.append(entry)
+
+        for fname in fnames:
+            if fname.endswith(self.EML_SUFFIX) and fname[:-len(self.EML_SUFFIX)] + self.REC_SUFFIX not in fnames:
+                os.remove(os.path.join(self.newDir, fname))
+
+        self.entries.sort(key=lambda e: e.name)
+
+    def read_entry(self, name):
+        """Читает файл .rec письма name. Возвращает экземпляр SpoolEntry
+        или None, если файл кривой."""
+
+        url = None
+        attempts = 0
+        nexttry = 0
+        mailto = None
+        feeds = {}
+
+        fname = self.entry_file_name(name, self.REC_SUFFIX)
+        fseen = int(os.path.getmtime(fname))
+
+        with open(fname, 'r', encoding=IOENCODING) as f:
+            # заголовок - до пустой строки
+            for s in f:
+                s = s.strip()
+                if not s:
+                    break
+
+                if u':' not in s:
+                    continue
+
+                pname, pval = s.split(u':', 1)
+                pname = pname.strip().lower()
+                pval = pval.strip()
+
+                try:
+                    if pname == self.PARAM_URL:
+                        url = pval
+                    elif pname == self.PARAM_ATTEMPTS:
+                        attempts = int(pval)
+                    elif pname == self.PARAM_NEXTTRY:
+                        nexttry = int(pval)
+                    elif pname == self.PARAM_TO:
+                        mailto = list(filter(None, map(lambda t: t.strip(), pval.split(u','))))
+                except ValueError:
+                    pass
+
+            # url в заголовке - у файлов с записями одной ленты
+            # (от предыдущих версий)
+            records = feeds.setdefault(url, []) if url else None
+
+            for s in f:
+                if not s.strip():
+                    records = None
+                    continue
+
+                if records is None:
+                    # первая строка блока
+                    if s.startswith(self.PARAM_URL + u':'):
+                        records = feeds.setdefault(s.split(u':', 1)[1].strip(), [])
+                    continue
+
+                r = parse_history_record(s, fseen)
+                if r is not None:
+                    records.append(r)
+
+        if not feeds or not os.path.isfile(self.entry_file_name(name, self.EML_SUFFIX)):
+            return None
+
+        return SpoolEntry(self, name, feeds, attempts, nexttry, mailto if mailto else None)
+
+    def write_rec(self, entry, tmp):
+        with open(self.entry_file_name(entry.name, self.REC_SUFFIX, tmp), 'w+', encoding=IOENCODING) as f:
+            f.write(u'%s: %d\n%s: %d\n' % (self.PARAM_ATTEMPTS, entry.attempts,
+                self.PARAM_NEXTTRY, entry.nextTry))
+
+            if entry.mailTo:
+                f.write(u'%s: %s\n' % (self.PARAM_TO, u', '.join(entry.mailTo)))
+
+            for url, records in entry.feeds.items():
+                f.write(u'\n%s: %s\n' % (self.PARAM_URL, url))
+
+                for r in records:
+                    f.write(format_history_record(r))
+
+    def store(self, msg, feeds, mailto=None):
+        """Ставит в очередь письмо msg (экземпляр MessageStream или bytes)
+        с записями истории лент
+        feeds (словарь, где ключи - адреса лент, а значения - списки
+        экземпляров historyrecord).
+        mailto - список адресов получателей (если None - из общих настроек).
+        Возвращает экземпляр SpoolEntry."""
+
+        self.make_dirs()
+
+        self.nameCounter += 1
+        # уникальное имя, как в maildir
+        name = u'%d.%d_%d' % (time() * 1000, os.getpid(), self.nameCounter)
+
+        # первая повторная попытка - при следующем запуске
+        entry = SpoolEntry(self, name, feeds, mailto=mailto)
+
+        with open(self.entry_file_name(name, self.EML_SUFFIX, True), 'wb+') as f:
+            if isinstance(msg, bytes):
+                f.write(msg)
+            else:
+                msg.write_to(f)
+
+        self.write_rec(entry, True)
+
+        os.replace(self.entry_file_name(name, self.EML_SUFFIX, True), self.entry_file_name(name, self.EML_SUFFIX))
+        os.replace(self.entry_file_name(name, self.REC_SUFFIX, True), self.entry_file_name(name, self.REC_SUFFIX))
+
+        self.entries.append(entry)
+
+        return entry
+
+    def remove(self, entry):
+        """Удаляет из очереди отправленное письмо."""
+
+        # сначала .rec - после этого письмо уже не в очереди
+        for suffix in (self.REC_SUFFIX, self.EML_SUFFIX):
+            fname = self.entry_file_name(entry.name, suffix)
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+        self.entries.remove(entry)
+
+    def defer(self, entry):
+        """Учёт неудачной попытки отправки письма entry: следующая попытка
+        откладывается."""
+
+        entry.attempts += 1
+        entry.nextTry = int(time()) + min(self.RETRY_DELAY * 2 ** (entry.attempts - 1), self.RETRY_DELAY_MAX)
+
+        self.make_dirs()
+
+        self.write_rec(entry, True)
+        os.replace(self.entry_file_name(entry.name, self.REC_SUFFIX, True), self.entry_file_name(entry.name, self.REC_SUFFIX))
+
+    def due_entries(self):
+        """Возвращает список писем, которые пора отправить."""
+
+        now = time()
+
+        return list(filter(lambda e: e.nextTry <= now, self.entries))
+
+    def pending_records(self, url):
+        """Возвращает список записей истории ленты с адресом url
+        из всех писем в очереди."""
+
+        records = []
+
+        for entry in self.entries:
+            records += entry.feeds.get(url, [])
+
+        return records